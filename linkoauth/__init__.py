@@ -21,4 +21,4 @@
 # Contributor(s):
 
 # exposing the class registers existing backends
-from linkoauth.backends import Services   # NOQA
+from linkoauth.backends import Services, AsyncServices   # NOQA
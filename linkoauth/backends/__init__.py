@@ -21,20 +21,34 @@
 # Contributor(s):
 #
 import abc
+import httplib
+import logging
+import socket
+import threading
+import time
+from multiprocessing import TimeoutError
 
 from webob.exc import HTTPRedirection
 from services.pluginreg import PluginRegistry
 
 from linkoauth.backends import facebook_, google_, twitter_, yahoo_, linkedin_
 from linkoauth.sstatus import ServicesStatus
+from linkoauth.pool import RequesterPool, fingerprint
+from linkoauth.breaker import CircuitBreaker
+from linkoauth.bulkhead import Bulkhead
+from linkoauth.metrics import Metrics
+from linkoauth.util import get_settings
+from linkoauth.workers import WorkerPool
 from linkoauth.errors import BackendError, DomainNotRegisteredError
-from linkoauth.errors import OAuthKeysException
+from linkoauth.errors import OAuthKeysException, ServiceUnavailableException
 
 #from linkoauth.live_ import LiveResponder
 #from linkoauth.openidconsumer import OpenIDResponder
 
 __all__ = ['Responder', 'get_responder', 'Requester', 'get_requester',
-           'Services']
+           'Services', 'AsyncServices']
+
+log = logging.getLogger(__name__)
 
 
 class Responder(PluginRegistry):
@@ -127,11 +141,51 @@ def get_requester(domain, account, **kw):
             raise
 
 
+# exceptions telling that the provider could not be reached
+_UNAVAILABLE = (socket.error, httplib.HTTPException,
+                ServiceUnavailableException)
+
+
+def _exception_error(domain, exc):
+    """Returns the error dict of an exception raised by a call."""
+    error = {'provider': domain,
+             'message': str(exc) or exc.__class__.__name__}
+    if isinstance(exc, HTTPRedirection):
+        error['status'] = exc.code
+        error['location'] = exc.location
+    elif isinstance(exc, _UNAVAILABLE):
+        error['status'] = 503
+    elif isinstance(exc, DomainNotRegisteredError):
+        error['status'] = 404
+    else:
+        error['status'] = 500
+    return error
+
+
+def _call(func, *args, **kw):
+    """Calls a provider method and returns (res, success).
+
+    *success* is True for a result, False for a backend error and None when
+    the provider returned an error, which is not reported.
+    """
+    try:
+        res = func(*args, **kw)
+    except BackendError, e:
+        return (None, e.args[0]), False
+    if len(res) == 2 and res[0] is not None:
+        return res, True
+    return res, None
+
+
 # high-level
 class Services(ServicesStatus):
 
     def __init__(self, services, servers=None, ttl=600,
-                 feedback_enabled=True):
+                 feedback_enabled=True, requester_pool_size=1000,
+                 requester_pool_ttl=300, workers=10, circuit_breaker=None,
+                 flush_interval=None, flush_size=100, status_pool_size=10,
+                 status_shards=1, status_bucket_width=60,
+                 broadcast_workers=2):
         requesters = [req.get_name() for req in Requester._abc_registry]
         responders = [res.get_name() for res in Responder._abc_registry]
 
@@ -143,41 +197,317 @@ class Services(ServicesStatus):
                 raise DomainNotRegisteredError(service)
 
         self.feedback_enabled = feedback_enabled
-        ServicesStatus.__init__(self, services, servers, ttl)
+        self._requesters = RequesterPool(requester_pool_size,
+                                         requester_pool_ttl)
+        self._workers = WorkerPool(workers)
+        # broadcast sends run on a small pool per domain, and the sends
+        # still running are counted per domain
+        self.broadcast_workers = broadcast_workers
+        self._broadcast_pools = {}
+        self._broadcasting = {}
+        self._broadcast_lock = threading.Lock()
+        self.metrics = Metrics()
+        self._bulkheads = {}
+        self._bulkheads_lock = threading.Lock()
+        # circuit_breaker holds the CircuitBreaker options, None disables it
+        self._breakers = {}
+        if circuit_breaker is not None:
+            for service in services:
+                self._breakers[service] = CircuitBreaker(**circuit_breaker)
+        ServicesStatus.__init__(self, services, servers, ttl, flush_interval,
+                                flush_size, bucket_width=status_bucket_width,
+                                pool_size=status_pool_size,
+                                shards=status_shards)
+
+    def _get_requester(self, domain, account, **kw):
+        key = fingerprint(account, **kw)
+        if key is None:
+            return get_requester(domain, account, **kw)
+
+        def _create():
+            return get_requester(domain, account, **kw)
+
+        # requesters built from a previous configuration are rebuilt
+        return self._requesters.get((domain, key), _create, get_settings())
+
+    def invalidate(self, domain, account=None, **kw):
+        """Drops the pooled requesters of a domain.
+
+        Must be called when the tokens of an account change.  If *account*
+        is not provided, all the requesters of the domain are dropped.
+        """
+        domain = str(domain)
+        if account is None:
+            self._requesters.invalidate(domain)
+        else:
+            self._requesters.invalidate(domain, fingerprint(account, **kw))
+
+    def _report(self, domain, success, count=1):
+        """Feeds the outcome of *count* calls to the status counters.
+
+        *success* is None when the outcome should not be reported.
+        """
+        if success is not None and count > 0 and self.feedback_enabled:
+            self.update_status(domain, success, count)
+
+    def _get_bulkhead(self, domain):
+        """Returns the Bulkhead of a domain, or None if it has no limit.
+
+        The limits are read from the oauth.<domain>.max_concurrency,
+        max_queue and queue_timeout options.  The bulkhead is kept as long
+        as its limits don't change, whatever the configuration object.
+        """
+        options = get_settings().get_provider(domain)
+        limits = None
+        if options.get('max_concurrency'):
+            timeout = options.get('queue_timeout')
+            if timeout is not None:
+                timeout = float(timeout)
+            limits = (int(options['max_concurrency']),
+                      int(options.get('max_queue', 0)), timeout)
+
+        entry = self._bulkheads.get(domain)
+        if entry is not None and entry[0] == limits:
+            return entry[1]
+        with self._bulkheads_lock:
+            entry = self._bulkheads.get(domain)
+            if entry is None or entry[0] != limits:
+                bulkhead = limits is not None and Bulkhead(*limits) or None
+                entry = self._bulkheads[domain] = limits, bulkhead
+        return entry[1]
+
+    def _guarded(self, domain, func, *args, **kw):
+        """Calls func through the bulkhead and circuit breaker of the domain.
+
+        Returns (res, success) like _call.  When the breaker is open or
+        the bulkhead is full, the call is not made and an error is returned
+        right away.  The breaker is checked first, so the calls don't queue
+        in the bulkhead while it's open.  The calls made are timed in the
+        metrics, under the name of func.
+        """
+        breaker = self._breakers.get(domain)
+        if breaker is not None:
+            ticket = breaker.allow()
+            if ticket is None:
+                return (None, {'provider': domain,
+                               'message': 'the service is unavailable',
+                               'status': 503}), None
+
+        bulkhead = self._get_bulkhead(domain)
+        if bulkhead is not None and not bulkhead.acquire():
+            if breaker is not None:
+                # gives back the probe slot of a half-open breaker
+                breaker.record(ticket, None)
+            return (None, {'provider': domain,
+                           'message': 'too many concurrent requests',
+                           'status': 503}), None
+        try:
+            healthy = None
+            try:
+                with self.metrics.timed(domain, func.__name__):
+                    res, success = _call(func, *args, **kw)
+                healthy = success
+            except HTTPRedirection:
+                healthy = True
+                raise
+            except _UNAVAILABLE:
+                healthy = False
+                raise
+            finally:
+                if breaker is not None:
+                    breaker.record(ticket, healthy)
+            return res, success
+        finally:
+            if bulkhead is not None:
+                bulkhead.release()
 
     def _updated(func):
         def __updated(self, domain, *args, **kw):
             domain = str(domain)
             try:
-                res = func(self, domain, *args, **kw)
-            except BackendError, e:
-                if self.feedback_enabled:
-                    self.update_status(domain, False)
-                return None, e.args[0]
+                res, success = self._guarded(domain, func, self, domain,
+                                             *args, **kw)
             except HTTPRedirection:
-                if self.feedback_enabled:
-                    self.update_status(domain, True)
+                self._report(domain, True)
                 raise
-            else:
-                if (len(res) == 2 and res[0] is not None and
-                    self.feedback_enabled):
-                    self.update_status(domain, True)
+            self._report(domain, success)
             return res
         return __updated
 
     @_updated
     def sendmessage(self, domain, account, *args, **kw):
-        return get_requester(domain, account).sendmessage(*args, **kw)
+        return self._get_requester(domain, account).sendmessage(*args, **kw)
 
     @_updated
     def getcontacts(self, domain, account, page_data, headers, **kw):
-        return get_requester(domain, account, **kw).getcontacts(page_data,
-                                                                headers)
+        requester = self._get_requester(domain, account, **kw)
+        return requester.getcontacts(page_data, headers)
+
+    def sendmessage_many(self, domain, account, messages, max_workers=None):
+        """Sends several messages from the same account concurrently.
+
+        *messages* is a sequence of (message, options, headers) tuples.
+        Returns a list of (result, error) tuples in the same order.  When a
+        send raises an exception, the error describes it: a redirection
+        gets its status and location.
+
+        At most *max_workers* messages are sent at the same time.  The sends
+        run on the shared worker pool, so this is capped at its size: the
+        *workers* option of Services, 10 by default.
+
+        The status counters are updated once for the whole batch.
+        """
+        domain = str(domain)
+        requester = self._get_requester(domain, account)
+
+        def _send(args):
+            try:
+                return self._guarded(domain, requester.sendmessage, *args)
+            except HTTPRedirection, e:
+                return (None, _exception_error(domain, e)), True
+            except Exception, e:
+                # one broken message should not abort the whole batch
+                log.exception("failed to send a message to %s", domain)
+                return (None, _exception_error(domain, e)), None
+
+        outcomes = self._workers.map(_send, messages, max_workers)
+        results = []
+        counts = {True: 0, False: 0}
+        for res, success in outcomes:
+            results.append(res)
+            if success is not None:
+                counts[success] += 1
+
+        self._report(domain, True, counts[True])
+        self._report(domain, False, counts[False])
+        return results
+
+    def broadcast(self, message, targets, headers=None, timeout=None):
+        """Sends a message to several domains concurrently.
+
+        *targets* maps each domain to an (account, options) tuple.  Returns
+        a dict mapping each domain to a (result, error) tuple once all the
+        sends are done, or once *timeout* seconds have passed.  Domains that
+        did not answer in time get a timeout error; their send goes on in
+        the background and still updates the status counters.  A send
+        which raises gets the error dict of the exception.
+
+        The sends of each domain run on their own pool of
+        *broadcast_workers* threads, so a provider which hangs doesn't
+        hold up the others.  When that many sends of a domain are still
+        running, the domain gets an error right away.
+        """
+        def _send(domain, account, options):
+            try:
+                return Services.sendmessage(self, domain, account, message,
+                                            options, headers)
+            finally:
+                with self._broadcast_lock:
+                    self._broadcasting[domain] -= 1
+
+        results = {}
+        pending = {}
+        for domain, (account, options) in targets.items():
+            with self._broadcast_lock:
+                running = self._broadcasting.get(domain, 0)
+                if running >= self.broadcast_workers:
+                    results[domain] = None, {'provider': domain,
+                                             'message': 'too many pending '
+                                                        'requests',
+                                             'status': 503}
+                    continue
+                self._broadcasting[domain] = running + 1
+                pool = self._broadcast_pools.get(domain)
+                if pool is None:
+                    pool = WorkerPool(self.broadcast_workers)
+                    self._broadcast_pools[domain] = pool
+            pending[domain] = pool.submit(_send, domain, account, options)
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        for domain, call in pending.items():
+            if timeout is None:
+                wait = None
+            else:
+                wait = max(deadline - time.time(), 0)
+            try:
+                results[domain] = call.get(wait)
+            except TimeoutError:
+                results[domain] = None, {'provider': domain,
+                                         'message': 'timed out',
+                                         'status': 504}
+            except Exception, e:
+                results[domain] = None, _exception_error(domain, e)
+        return results
+
+    def iter_contacts(self, domain, account, page_data=None, headers=None,
+                      **kw):
+        """Yields the contacts of an account, one poco entry at a time.
+
+        The pages are followed through the pageData of each result, and the
+        next page is fetched in the background while the current one is
+        consumed.  Raises a BackendError if a page can't be fetched.
+        """
+        def _fetch(page_data):
+            return Services.getcontacts(self, domain, account, page_data,
+                                        headers, **kw)
+
+        page_data = page_data or {}
+        pending = self._workers.submit(_fetch, page_data)
+        while pending is not None:
+            result, error = pending.get()
+            if result is None:
+                raise BackendError(error)
+
+            next_page = result.get('pageData')
+            if next_page and next_page != page_data:
+                page_data = next_page
+                pending = self._workers.submit(_fetch, next_page)
+            else:
+                pending = None
+
+            for entry in result.get('entry', []):
+                yield entry
 
     def request_access(self, domain, request, url, session, **kw):
         return get_responder(domain, **kw).request_access(request, url,
                                                           session)
 
     def verify(self, domain, request, url, session, **kw):
-        return get_responder(domain, **kw).verify(request, url,
-                                                  session)
+        with self.metrics.timed(str(domain), 'verify'):
+            return get_responder(domain, **kw).verify(request, url,
+                                                      session)
+
+
+class AsyncServices(Services):
+    """Services front-end that does not block on the providers.
+
+    The calls run on their own pool of *async_workers* threads, separate
+    from the one used by sendmessage_many, broadcast and iter_contacts, and
+    each method returns an AsyncResult right away.  At most *async_workers*
+    calls are in flight: the others wait in the pool queue.  Its get()
+    method returns what the Services method returns, or raises what it
+    raises.  Results are normalized and fed to the status counters exactly
+    like the Services calls.
+    """
+    def __init__(self, services, async_workers=100, **kw):
+        Services.__init__(self, services, **kw)
+        self._async_workers = WorkerPool(async_workers)
+
+    def sendmessage(self, domain, account, *args, **kw):
+        return self._async_workers.submit(Services.sendmessage, self, domain,
+                                          account, *args, **kw)
+
+    def getcontacts(self, domain, account, page_data, headers, **kw):
+        return self._async_workers.submit(Services.getcontacts, self, domain,
+                                          account, page_data, headers, **kw)
+
+    def request_access(self, domain, request, url, session, **kw):
+        return self._async_workers.submit(Services.request_access, self,
+                                          domain, request, url, session,
+                                          **kw)
+
+    def verify(self, domain, request, url, session, **kw):
+        return self._async_workers.submit(Services.verify, self, domain,
+                                          request, url, session, **kw)
@@ -28,7 +28,6 @@ or optionally can use OpenId+OAuth hybrid protocol to request access to
 Google Apps using OAuth2.
 
 """
-import os
 import urlparse
 import socket
 
@@ -54,7 +53,7 @@ from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email.header import Header
 
-from linkoauth.util import config, asbool, render
+from linkoauth.util import config, render, get_settings
 from linkoauth.util import safeHTML, literal
 from linkoauth.oid_extensions import OAuthRequest
 from linkoauth.oid_extensions import UIRequest
@@ -62,6 +61,7 @@ from linkoauth.openidconsumer import ax_attributes, attributes
 from linkoauth.openidconsumer import OpenIDResponder
 from linkoauth.oauth import get_oauth_config
 from linkoauth.protocap import ProtocolCapturingBase, OAuth2Requestor
+from linkoauth.protocap import capture_enabled, truncate
 from linkoauth.errors import BackendError, OptionError, OAuthKeysException
 
 GOOGLE_OAUTH = 'https://www.google.com/accounts/OAuthGetAccessToken'
@@ -268,6 +268,8 @@ class SMTPRequestorImpl(SMTP, ProtocolCapturingBase):
     def __init__(self, host, port):
         self._record = []
         self.pc_host = host
+        # nothing is recorded if no capture can be written
+        self._recording = capture_enabled(self.pc_protocol, host)
         SMTP.__init__(self, host, port)
         ProtocolCapturingBase.__init__(self)
 
@@ -275,14 +277,20 @@ class SMTPRequestorImpl(SMTP, ProtocolCapturingBase):
         return self.pc_host
 
     def send(self, str):
-        msg = "> " + "\n+ ".join(str.splitlines()) + "\n"
-        self._record.append(msg)
+        if self._recording:
+            data, length = truncate(str, get_settings().capture_max_body)
+            msg = "> " + "\n+ ".join(data.splitlines()) + "\n"
+            if length is not None:
+                msg += "+ [%d bytes truncated]\n" % (length - len(data))
+            self._record.append(msg)
         SMTP.send(self, str)
 
     def getreply(self):
         try:
             errcode, errmsg = SMTP.getreply(self)
         except Exception, exc:
+            if not self._recording:
+                raise
             try:
                 module = getattr(exc, '__module__', None)
                 erepr = {'module': module, 'name': exc.__class__.__name__,
@@ -292,20 +300,22 @@ class SMTPRequestorImpl(SMTP, ProtocolCapturingBase):
                 log.exception("failed to serialize an SMTP exception")
             raise
 
-        msg = "\n+ ".join(errmsg.splitlines()) + "\n"
-        self._record.append("< %d %s" % (errcode, msg))
+        if self._recording:
+            msg = "\n+ ".join(errmsg.splitlines()) + "\n"
+            self._record.append("< %d %s" % (errcode, msg))
         return errcode, errmsg
 
     def sendmail(self, *args, **kw):
         SMTP.sendmail(self, *args, **kw)
-        if asbool(config.get('protocol_capture_success')):
+        if get_settings().capture_success:
             self.save_capture("automatic success save")
 
-    def _save_capture(self, dirname):
-        with open(os.path.join(dirname, "smtp-trace"), "wb") as f:
-            f.writelines(self._record)
-        self._record = []
-        return None
+    def _get_capture(self):
+        record, self._record = self._record, []
+        return record
+
+    def _capture_files(self, record):
+        return [("smtp-trace", ''.join(record))], None
 
 SMTPRequestor = SMTPRequestorImpl
 
@@ -441,7 +451,7 @@ class GoogleRequester(object):
         try:
             server = SMTPRequestor(self.host, self.port)
             # in the app:main set debug = true to enable
-            if asbool(config.get('debug', False)):
+            if get_settings().debug:
                 server.set_debuglevel(True)
             try:
                 try:
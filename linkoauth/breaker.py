@@ -0,0 +1,150 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+In-process circuit breaker.
+
+The breaker is closed as long as the failure rate of the calls made in the
+last *window* seconds stays under *failure_rate*.  Once it's reached (with at
+least *min_calls* calls), the breaker opens and the calls are rejected
+without reaching the provider.
+
+After *reset_timeout* seconds the breaker becomes half-open and lets
+*probes* calls through.  If they all succeed the breaker closes, and any
+failure opens it again.
+
+allow() returns a ticket for each call let through, which is given back
+to record() with the outcome of the call.  The outcomes of the calls let
+through before the breaker last opened or closed are ignored, so a slow
+call made while closed can't pass for a probe.
+"""
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, window=60, buckets=10, min_calls=20, failure_rate=0.5,
+                 reset_timeout=30, probes=3):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self._width = float(window) / buckets
+        # each bucket is [bucket number, successes, failures]
+        self._buckets = [[-1, 0, 0] for i in range(buckets)]
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._opened_at = 0
+        self._probing = 0
+        self._probed = 0
+        # changes each time the breaker opens or closes
+        self._generation = 0
+
+    def _bucket(self, now):
+        number = int(now / self._width)
+        bucket = self._buckets[number % len(self._buckets)]
+        if bucket[0] != number:
+            bucket[:] = [number, 0, 0]
+        return bucket
+
+    def _counts(self, now):
+        oldest = int(now / self._width) - len(self._buckets)
+        succ = fail = 0
+        for number, bsucc, bfail in self._buckets:
+            if number > oldest:
+                succ += bsucc
+                fail += bfail
+        return succ, fail
+
+    def _open(self, now):
+        self._generation += 1
+        self.state = OPEN
+        self._opened_at = now
+        self._probing = self._probed = 0
+
+    def _close(self):
+        self._generation += 1
+        self.state = CLOSED
+        for bucket in self._buckets:
+            bucket[:] = [-1, 0, 0]
+
+    def allow(self):
+        """Returns the ticket of the call if it can be made, else None."""
+        with self._lock:
+            if self.state == CLOSED:
+                return self._generation, False
+
+            if self.state == OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    return None
+                self.state = HALF_OPEN
+
+            if self._probing + self._probed >= self.probes:
+                return None
+            self._probing += 1
+            return self._generation, True
+
+    def record(self, ticket, success):
+        """Records the outcome of the call allowed with *ticket*.
+
+        *success* is None when the call says nothing about the health of
+        the provider.
+        """
+        now = time.time()
+        generation, probe = ticket
+        with self._lock:
+            if generation != self._generation:
+                # allowed before the breaker opened or closed
+                return
+
+            if probe:
+                self._probing -= 1
+                if success is None:
+                    return
+                if not success:
+                    self._open(now)
+                    return
+                self._probed += 1
+                if self._probed >= self.probes:
+                    self._close()
+                return
+
+            if success is None:
+                return
+
+            bucket = self._bucket(now)
+            if success:
+                bucket[1] += 1
+                return
+            bucket[2] += 1
+
+            succ, fail = self._counts(now)
+            total = succ + fail
+            if (total >= self.min_calls and
+                float(fail) / total >= self.failure_rate):
+                self._open(now)
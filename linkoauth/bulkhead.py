@@ -0,0 +1,73 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Concurrency limits for the calls made to a provider.
+"""
+import threading
+import time
+
+
+class Bulkhead(object):
+    """Lets at most *max_concurrency* calls run at the same time.
+
+    Up to *max_queue* extra calls wait for a slot, for at most *timeout*
+    seconds (forever if None).  Calls beyond that are rejected right away.
+    """
+    def __init__(self, max_concurrency, max_queue=0, timeout=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Returns True if a slot was acquired, False if rejected."""
+        with self._cond:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+
+            self.waiting += 1
+            try:
+                if self.timeout is not None:
+                    deadline = time.time() + self.timeout
+                while self.active >= self.max_concurrency:
+                    if self.timeout is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
@@ -0,0 +1,220 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Storage of the protocol captures.
+
+A capture is a name, a metadata dict and a list of (filename, data) files.
+It's either written as a directory holding the files and a meta.json file,
+or appended to a capture log.
+
+A capture log is a directory of segment files, each process appending to
+its own segment.  Each record is a header (payload length, flags, crc32)
+followed by the payload, optionally zlib-compressed: a JSON line with the
+name, the metadata and the file sizes, then the files data.
+
+The captures of both layouts can be read back with iter_captures.  To
+export a capture log to the directory layout:
+
+    $ python -m linkoauth.capturelog /path/to/log /path/to/captures
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+# payload length, flags, crc32 of the payload
+_RECORD = struct.Struct('>IBI')
+_COMPRESSED = 1
+
+
+def write_capture_dir(base_path, name, meta, files):
+    """Writes a capture in the *name* directory of *base_path*."""
+    dirname = os.path.join(base_path, name)
+    os.makedirs(dirname)
+    for filename, data in files:
+        with open(os.path.join(dirname, filename), "wb") as f:
+            f.write(data)
+    with open(os.path.join(dirname, "meta.json"), "wb") as f:
+        json.dump(meta, f, sort_keys=True, indent=4)
+        f.write("\n")
+    return dirname
+
+
+def read_capture_dir(path):
+    """Returns the (name, meta, files) capture of the *path* directory."""
+    with open(os.path.join(path, "meta.json"), "rb") as f:
+        meta = json.load(f)
+    files = []
+    for filename in sorted(os.listdir(path)):
+        if filename == "meta.json":
+            continue
+        with open(os.path.join(path, filename), "rb") as f:
+            files.append((filename, f.read()))
+    return os.path.basename(path), meta, files
+
+
+class CaptureDirectory(object):
+    """Writes each capture in its own directory of *path*."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, name, meta, files):
+        if not os.path.isdir(self.path):
+            log.warn("want to write a request capture, "
+                     "but directory %r does not exist", self.path)
+            return
+        write_capture_dir(self.path, name, meta, files)
+
+
+def _encode(name, meta, files, compress):
+    files = [(filename, isinstance(data, unicode) and data.encode('utf8')
+              or data) for filename, data in files]
+    header = json.dumps({'name': name, 'meta': meta,
+                         'files': [[filename, len(data)]
+                                   for filename, data in files]})
+    payload = header + '\n' + ''.join([data for filename, data in files])
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= _COMPRESSED
+    crc = zlib.crc32(payload) & 0xffffffff
+    return _RECORD.pack(len(payload), flags, crc) + payload
+
+
+class CaptureLog(object):
+    """Appends the captures to segment files in *path*.
+
+    A new segment is started when the current one reaches *segment_size*
+    bytes, and in a child process after a fork.
+    """
+    def __init__(self, path, segment_size=64 * 1024 * 1024, compress=True):
+        self.path = path
+        self.segment_size = segment_size
+        self.compress = compress
+        self._file = None
+        self._pid = None
+        self._size = 0
+
+    def _segment(self):
+        pid = os.getpid()
+        if (self._file is None or self._pid != pid or
+            self._size >= self.segment_size):
+            if self._file is not None and self._pid == pid:
+                self._file.close()
+            filename = 'captures-%d-%d.log' % (time.time() * 1000000, pid)
+            self._file = open(os.path.join(self.path, filename), 'ab')
+            self._pid = pid
+            self._size = 0
+        return self._file
+
+    def write(self, name, meta, files):
+        if not os.path.isdir(self.path):
+            log.warn("want to write a request capture, "
+                     "but directory %r does not exist", self.path)
+            return
+        record = _encode(name, meta, files, self.compress)
+        f = self._segment()
+        f.write(record)
+        f.flush()
+        self._size += len(record)
+
+    def close(self):
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+
+
+def read_segment(path):
+    """Yields the (name, meta, files) captures of a segment file.
+
+    A truncated or corrupted record ends the segment.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            length, flags, crc = _RECORD.unpack(header)
+            payload = f.read(length)
+            if (len(payload) < length or
+                zlib.crc32(payload) & 0xffffffff != crc):
+                log.warn("corrupted record in %s", path)
+                return
+            if flags & _COMPRESSED:
+                payload = zlib.decompress(payload)
+            header, body = payload.split('\n', 1)
+            header = json.loads(header)
+            files = []
+            pos = 0
+            for filename, size in header['files']:
+                files.append((filename, body[pos:pos + size]))
+                pos += size
+            yield header['name'], header['meta'], files
+
+
+def iter_captures(path):
+    """Yields the captures of a segment file, of a capture log, or of a
+    directory of captures.
+    """
+    if not os.path.isdir(path):
+        for capture in read_segment(path):
+            yield capture
+        return
+    filenames = os.listdir(path)
+    segments = [filename for filename in filenames
+                if filename.startswith('captures-') and
+                filename.endswith('.log')]
+    # sorted by creation time
+    segments.sort(key=lambda filename: int(filename.split('-')[1]))
+    for filename in segments:
+        for capture in read_segment(os.path.join(path, filename)):
+            yield capture
+    for filename in sorted(filenames):
+        dirname = os.path.join(path, filename)
+        if os.path.isfile(os.path.join(dirname, "meta.json")):
+            yield read_capture_dir(dirname)
+
+
+def export(path, dest):
+    """Writes the captures of a capture log in the directory layout.
+
+    Returns the number of captures written.
+    """
+    count = 0
+    for name, meta, files in iter_captures(path):
+        write_capture_dir(dest, name, meta, files)
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: capturelog log_path destination')
+        sys.exit(1)
+    print('%d captures exported.' % export(sys.argv[1], sys.argv[2]))
@@ -45,7 +45,10 @@ class StatusReadError(Exception):
 
 
 class StatusWriteError(Exception):
-    pass
+    def __init__(self, *args, **kw):
+        # the counter deltas that were not written, when known
+        self.unapplied = kw.pop('unapplied', None)
+        Exception.__init__(self, *args, **kw)
 
 
 class OAuthKeysException(Exception):
@@ -0,0 +1,125 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Latency histograms and in-flight gauges of the provider calls.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+class Histogram(object):
+    """Fixed-bucket histogram.
+
+    The last count is for the values above the highest bucket.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the percentile.
+
+        Returns the highest observed value if it's above the last bucket.
+        """
+        if self.count == 0:
+            return None
+        rank = self.count * percent / 100.
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'buckets': zip(self.buckets, self.counts[:-1]),
+                'overflow': self.counts[-1],
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+
+class Metrics(object):
+    """Records the calls made to each domain, per operation."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, domain, operation):
+        """Context manager timing a call."""
+        key = domain, operation
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self._in_flight[key] -= 1
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = \
+                            Histogram(self.buckets)
+                histogram.observe(elapsed)
+
+    def snapshot(self):
+        """Returns {domain: {operation: stats}}.
+
+        The stats are the histogram snapshot plus the number of calls
+        currently in flight.
+        """
+        res = {}
+        with self._lock:
+            for key in set(self._histograms) | set(self._in_flight):
+                domain, operation = key
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    stats = Histogram(self.buckets).snapshot()
+                else:
+                    stats = histogram.snapshot()
+                stats['in_flight'] = self._in_flight.get(key, 0)
+                res.setdefault(domain, {})[operation] = stats
+        return res
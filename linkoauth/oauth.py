@@ -33,7 +33,7 @@ import logging
 
 import oauth2 as oauth
 
-from linkoauth.util import config, redirect, asbool, build_url
+from linkoauth.util import redirect, asbool, build_url, get_settings
 from linkoauth.protocap import HttpRequestor
 from linkoauth.errors import BadVersionError, AccessException
 
@@ -42,13 +42,8 @@ log = logging.getLogger("oauth.base")
 
 
 def get_oauth_config(provider):
-    key = 'oauth.%s.' % provider
-    keylen = len(key)
-    d = {}
-    for k, v in config.items():
-        if k.startswith(key):
-            d[k[keylen:]] = v
-    return d
+    """Returns the read-only options of the "oauth.<provider>." namespace."""
+    return get_settings().get_provider(provider)
 
 
 class OAuth1(object):
@@ -0,0 +1,109 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Pooling of requester instances.
+
+Building a requester means reading the provider configuration and creating
+the oauth consumer, token and signature objects.  The requesters keep no
+per-call state, so the same instance can be reused for every call made with
+the same account.
+"""
+import json
+import threading
+import time
+from hashlib import sha1
+from collections import OrderedDict
+
+
+def fingerprint(account, **kw):
+    """Returns a hash of the account and the requester options.
+
+    Returns None when the values can't be serialized, in which case
+    the requester should not be pooled.
+    """
+    try:
+        data = json.dumps([account, kw], sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return sha1(data).hexdigest()
+
+
+class RequesterPool(object):
+    """Bounded LRU pool of requesters, keyed by (domain, fingerprint).
+
+    Entries older than *ttl* seconds are rebuilt on their next lookup.
+    A *size* of 0 disables pooling.
+    """
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, factory, generation=None):
+        """Returns the requester stored under *key*.
+
+        *factory* is called without arguments to build a new requester
+        when there's no valid entry.  Entries built for another
+        *generation* (compared by identity) are not valid.
+        """
+        if self.size <= 0:
+            return factory()
+
+        now = time.time()
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if (entry is not None and now - entry[0] < self.ttl and
+                entry[1] is generation):
+                # re-inserting moves the key to the most recent end
+                self._items[key] = entry
+                return entry[2]
+
+        # building happens outside of the lock: two threads may build
+        # the same requester, the last one wins.
+        requester = factory()
+        with self._lock:
+            self._items[key] = now, generation, requester
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return requester
+
+    def invalidate(self, domain, fingerprint=None):
+        """Drops the pooled requesters of *domain*.
+
+        If *fingerprint* is given, only that entry is removed.
+        """
+        with self._lock:
+            if fingerprint is not None:
+                self._items.pop((domain, fingerprint), None)
+                return
+            for key in self._items.keys():
+                if key[0] == domain:
+                    del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -20,21 +20,197 @@
 #
 # Contributor(s):
 #
-import os
-import json
 import httplib2
 import random
 import time
+import atexit
 import logging
+import threading
 import urlparse
+from Queue import Queue, Full
 
 import oauth2
+from linkoauth.capturelog import CaptureDirectory, CaptureLog
 from linkoauth.errors import OptionError
-from linkoauth.util import config, asbool
+from linkoauth.util import get_settings
+from linkoauth.workers import BackgroundThread
 
 log = logging.getLogger(__name__)
 
 
+class CaptureWriter(object):
+    """Writes the captures from a background thread.
+
+    The captures wait in a queue of at most *size* entries.  When it's
+    full, new captures are dropped and counted in *dropped*.
+
+    The thread is started on first use, and again in a child process
+    after a fork.
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self.dropped = 0
+        self._queue = None
+        self._thread = BackgroundThread(self._run, self._new_queue)
+        self._lock = threading.Lock()
+
+    def _new_queue(self):
+        self._queue = Queue(self.size)
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            func, args = queue.get()
+            try:
+                func(*args)
+            except Exception:
+                log.exception("failed to write a capture log")
+            finally:
+                queue.task_done()
+
+    def submit(self, func, *args):
+        """Queues func(*args).  Returns False if the capture was dropped."""
+        self._thread.start()
+        try:
+            self._queue.put_nowait((func, args))
+        except Full:
+            with self._lock:
+                self.dropped += 1
+            log.warn("capture queue full, %d captures dropped so far",
+                     self.dropped)
+            return False
+        return True
+
+    def flush(self):
+        """Waits until the queued captures are written."""
+        if self._thread.started:
+            self._queue.join()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+_sinks = {}
+
+
+def get_capture_sink():
+    """Returns where the captures of the current settings are written.
+
+    With protocol_capture_format = log, the captures are appended to a
+    capture log in protocol_capture_path, see linkoauth.capturelog.
+    Otherwise each capture is written in its own directory.
+    """
+    settings = get_settings()
+    key = (settings.capture_path, settings.capture_format,
+           settings.capture_segment_size, settings.capture_compress)
+    sink = _sinks.get(key)
+    if sink is None:
+        if settings.capture_format == 'log':
+            sink = CaptureLog(settings.capture_path,
+                              settings.capture_segment_size,
+                              settings.capture_compress)
+        else:
+            sink = CaptureDirectory(settings.capture_path)
+        sink = _sinks.setdefault(key, sink)
+    return sink
+
+
+def get_capture_writer():
+    """Returns the process CaptureWriter.
+
+    It's created on first use, sized by protocol_capture_queue_size, and
+    flushed when the interpreter exits.
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = CaptureWriter(get_settings().capture_queue_size)
+                atexit.register(_writer.flush)
+    return _writer
+
+
+class TokenBucket(object):
+    """Allows *rate* events per second, in bursts of up to *burst*."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def take(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CaptureLimiter(object):
+    """Decides which captures are written.
+
+    A capture is kept with the sample rate of its protocol and host, then
+    takes a token from the bucket of its (protocol, host, reason).  The
+    policies are read from the settings, see Settings.get_capture_policy.
+    The captures left out are counted in *skipped*.
+    """
+    def __init__(self):
+        self.skipped = 0
+        self._buckets = {}
+        self._settings = None
+        self._lock = threading.Lock()
+
+    def allow(self, protocol, host, reason):
+        settings = get_settings()
+        sample_rate, rate, burst = settings.get_capture_policy(protocol,
+                                                               host)
+        if sample_rate < 1 and random.random() >= sample_rate:
+            allowed = False
+        elif rate is None:
+            return True
+        else:
+            key = protocol, host, reason
+            with self._lock:
+                if self._settings is not settings:
+                    # the policies may have changed
+                    self._buckets = {}
+                    self._settings = settings
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(rate, burst)
+                allowed = bucket.take()
+        if not allowed:
+            with self._lock:
+                self.skipped += 1
+        return allowed
+
+
+limiter = CaptureLimiter()
+
+
+def capture_enabled(protocol, host):
+    """Returns False if no capture of *protocol* and *host* can be written.
+
+    The recorders don't record anything in that case.
+    """
+    settings = get_settings()
+    if not settings.capture_path:
+        return False
+    return settings.get_capture_policy(protocol, host)[0] > 0
+
+
+def truncate(data, size):
+    """Returns the first *size* bytes of data, and its original length."""
+    if data is None or len(data) <= size:
+        return data, None
+    return data[:size], len(data)
+
+
 # A capturing base-class - not specific to a single protocol
 class ProtocolCapturingBase(object):
     pc_protocol = None   # should be set by sub-classes
@@ -46,38 +222,45 @@ class ProtocolCapturingBase(object):
     def pc_get_host(self):
         raise NotImplementedError   # subclasses must provide this
 
-    def _save_capture(self, dirname):
-        raise NotImplementedError   # subclasses must provide this
+    def _get_capture(self):
+        # subclasses must provide this: returns what _write_capture needs,
+        # it's called in the request thread, so must not do any I/O
+        raise NotImplementedError
+
+    def _capture_files(self, capture):
+        # subclasses must provide this: returns the (filename, data) files
+        # of the capture and its metadata, it's called in the writer thread
+        raise NotImplementedError
 
     def save_capture(self, reason="no reason"):
+        """Queues the capture, it's written by the CaptureWriter."""
         host = self.pc_get_host()
         try:
-            base_path = config.get('protocol_capture_path')
+            base_path = get_settings().capture_path
             if not base_path:
                 log.warn("want to write a request capture, "
                          "but no protocol_capture_path is defined")
                 return
-            if not os.path.isdir(base_path):
-                log.warn("want to write a request capture, "
-                         "but directory %r does not exist", base_path)
+            if not limiter.allow(self.pc_protocol, host, reason):
+                log.debug("skipped a '%s' capture: %s", self.pc_protocol,
+                          reason)
                 return
 
             thisdir = "%s-%s-%s-%s" % (self.pc_protocol, host, time.time(),
                                        random.getrandbits(32))
-            dirname = os.path.join(base_path, thisdir)
-            os.makedirs(dirname)
-            # call the subclass to save itself and return the metadata
             meta = {'protocol': self.pc_protocol, 'reason': reason}
-            submeta = self._save_capture(dirname)
-            if submeta:
-                meta.update(submeta)
-            meta_file = os.path.join(dirname, "meta.json")
-            with open(meta_file, "wb") as f:
-                json.dump(meta, f, sort_keys=True, indent=4)
-                f.write("\n")
-            log.info("wrote '%s' capture to %s", self.pc_protocol, dirname)
+            get_capture_writer().submit(self._write, get_capture_sink(),
+                                        thisdir, meta, self._get_capture())
         except Exception:
-            log.exception("failed to write a capture log")
+            log.exception("failed to queue a capture log")
+
+    def _write(self, sink, name, meta, capture):
+        # call the subclass to get the files and the metadata
+        files, submeta = self._capture_files(capture)
+        if submeta:
+            meta.update(submeta)
+        sink.write(name, meta, files)
+        log.info("wrote '%s' capture %s", self.pc_protocol, name)
 
 # Stuff for http captures
 
@@ -88,21 +271,35 @@ class ProtocolCapturingBase(object):
 # }
 # connections will usually have 1 entry but may have more due to things
 # like redirects and the auto retry capability builtin to httplib2.
+#
+# Nothing is recorded when no capture can be written, and the bodies are
+# truncated to protocol_capture_max_body bytes; the original lengths are
+# kept in 'body_length' and 'content_length'.
 class RecordingHttpBase(object):
     def __init__(self):
         self.capture = None
+        self.recording = False
 
     def request(self, uri, *args):
         self.capture = {'uri': uri, 'connections': []}
+        self.recording = capture_enabled('http',
+                                         urlparse.urlparse(uri).netloc)
         return super(RecordingHttpBase, self).request(uri, *args)
 
     def _conn_request(self, conn, request_uri, method, body, headers):
+        klass = super(RecordingHttpBase, self)
+        if not self.recording:
+            return klass._conn_request(conn, request_uri, method, body,
+                                       headers)
+
+        max_body = get_settings().capture_max_body
         connections = self.capture['connections']
-        this_con = {'path': request_uri, 'method': method, 'body': body,
-                    'headers': headers}
+        recorded_body, body_length = truncate(body, max_body)
+        this_con = {'path': request_uri, 'method': method,
+                    'body': recorded_body, 'headers': headers,
+                    'body_length': body_length}
         connections.append(this_con)
         try:
-            klass = super(RecordingHttpBase, self)
             response, content = klass._conn_request(conn, request_uri,
                                                     method, body, headers)
         except Exception, e:
@@ -111,7 +308,8 @@ class RecordingHttpBase(object):
         this_con['response_headers'] = response
         this_con['response_status'] = response.status
         this_con['response_reason'] = response.reason
-        this_con['content'] = content
+        this_con['content'], this_con['content_length'] = \
+                truncate(content, max_body)
         return response, content
 
 
@@ -138,34 +336,45 @@ class HttpRequestor(ProtocolCapturingBase):
     def request(self, uri, method="GET", body='', headers=None):
         response, data = self.http.request(uri, method, body, headers)
         if (300 > int(response['status']) >= 200 and
-            asbool(config.get('protocol_capture_success'))):
+            get_settings().capture_success):
             self.save_capture("automatic success save")
         return response, data
 
-    def _save_capture(self, dirname):
-        capture = self.http.capture
+    def _get_capture(self):
+        # request() starts a new capture, so this one won't change
+        return self.http.capture
+
+    def _capture_files(self, capture):
+        files = []
+        truncated = {}
         for i, con in enumerate(capture['connections']):
-            req_file = os.path.join(dirname, "request-%d" % i)
-            with open(req_file, "wb") as f:
-                f.write("%s %s\r\n" % (con['method'], con['path']))
-                for n, v in con['headers'].iteritems():
-                    f.write("%s: %s\r\n" % (n, v))
-                f.write("\r\n")
-                if con['body']:
-                    f.write(con['body'])
+            if con.get('body_length') is not None:
+                truncated["request-%d" % i] = con['body_length']
+            if con.get('content_length') is not None:
+                truncated["response-%d" % i] = con['content_length']
+            req = ["%s %s\r\n" % (con['method'], con['path'])]
+            for n, v in con['headers'].iteritems():
+                req.append("%s: %s\r\n" % (n, v))
+            req.append("\r\n")
+            if con['body']:
+                req.append(con['body'])
+            files.append(("request-%d" % i, ''.join(req)))
             if 'response_status' in con:
-                resp_file = os.path.join(dirname, "response-%d" % i)
-                with open(resp_file, "wb") as f:
-                    f.write("HTTP/1.1 %s %s\r\n" % (con['response_status'],
-                                                    con['response_reason']))
-                    for n, v in con['response_headers'].iteritems():
-                        # we don't chunk on replay...
-                        if n != "transfer-encoding":
-                            f.write("%s: %s\r\n" % (n, v))
-                    f.write("\r\n")
-                    f.write(con['content'])
+                resp = ["HTTP/1.1 %s %s\r\n" % (con['response_status'],
+                                                con['response_reason'])]
+                for n, v in con['response_headers'].iteritems():
+                    # we don't chunk on replay...
+                    if n != "transfer-encoding":
+                        resp.append("%s: %s\r\n" % (n, v))
+                resp.append("\r\n")
+                resp.append(con['content'])
+                files.append(("response-%d" % i, ''.join(resp)))
             # XXX - todo - exceptions!
-        return {'uri': capture['uri']}
+        meta = {'uri': capture['uri']}
+        if truncated:
+            # the original lengths of the truncated bodies
+            meta['truncated'] = truncated
+        return files, meta
 
 
 # For code which uses the oauth2 library - still httplib2 based but with
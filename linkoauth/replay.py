@@ -0,0 +1,286 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Replay of the http protocol captures.
+
+A ReplayIndex maps the (method, host, path, normalized query) of the
+recorded requests to their responses.  It's served either in process, by
+the requestors of protocap once replaying() is entered, or by a local
+ReplayServer:
+
+    $ python -m linkoauth.replay /path/to/captures [port]
+
+The query is normalized by sorting its parameters and dropping the ones
+that change on every request (OAuth nonces, signatures, tokens...).  The
+responses of a request are served in turn, and the responses whose body
+was truncated when recorded are not indexed.
+"""
+import sys
+import threading
+import urllib
+import urlparse
+import logging
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
+
+import httplib2
+import oauth2
+from linkoauth import protocap
+from linkoauth.capturelog import iter_captures
+from linkoauth.protocap import RecordingHttpBase
+
+log = logging.getLogger(__name__)
+
+# query parameters which differ between the recording and the replay
+IGNORED_PARAMS = ('access_token', 'callback', 'sig', '_')
+IGNORED_PREFIXES = ('oauth_',)
+# response headers which don't apply to the replayed body
+_SKIPPED_HEADERS = ('status', 'content-location', 'content-encoding',
+                    '-content-encoding', 'content-length',
+                    'transfer-encoding')
+
+
+def normalize_query(query, ignored=IGNORED_PARAMS,
+                    ignored_prefixes=IGNORED_PREFIXES):
+    """Returns the sorted *query*, without the *ignored* parameters."""
+    params = [(name, value) for name, value
+              in urlparse.parse_qsl(query, keep_blank_values=True)
+              if name not in ignored and
+              not name.startswith(ignored_prefixes)]
+    params.sort()
+    return urllib.urlencode(params)
+
+
+def _parse_message(data):
+    """Returns the first line, the headers and the body of an http
+    message of a capture."""
+    head, sep, body = data.partition("\r\n\r\n")
+    lines = head.split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return lines[0], headers, body
+
+
+class ReplayIndex(object):
+    """The responses of the http captures of *path*, a directory of
+    captures or a capture log.
+    """
+    def __init__(self, path=None, ignored=IGNORED_PARAMS,
+                 ignored_prefixes=IGNORED_PREFIXES):
+        self.ignored = ignored
+        self.ignored_prefixes = ignored_prefixes
+        self.skipped = 0
+        self.misses = 0
+        self._responses = {}
+        self._next = {}
+        self._lock = threading.Lock()
+        if path is not None:
+            self.load(path)
+
+    def key(self, method, host, path, query):
+        host = host.lower().split(':')[0]
+        return (method.upper(), host, path,
+                normalize_query(query, self.ignored, self.ignored_prefixes))
+
+    def load(self, path):
+        """Indexes the captures of *path*, returns their number."""
+        count = 0
+        for name, meta, files in iter_captures(path):
+            if meta.get('protocol') != 'http':
+                continue
+            self.add(meta, dict(files))
+            count += 1
+        return count
+
+    def add(self, meta, files):
+        """Indexes the request-N / response-N *files* of a capture."""
+        host = urlparse.urlparse(meta['uri']).netloc
+        truncated = meta.get('truncated', {})
+        index = 0
+        while "request-%d" % index in files:
+            request = "request-%d" % index
+            response = "response-%d" % index
+            index += 1
+            if response not in files:
+                continue
+            if response in truncated:
+                log.debug("not indexing the truncated %s", response)
+                self.skipped += 1
+                continue
+            line, headers, body = _parse_message(files[request])
+            method, uri = line.split(" ", 1)
+            # the request line only holds the path, unless through a proxy
+            parsed = urlparse.urlparse(uri)
+            key = self.key(method, parsed.netloc or headers.get('host', host),
+                           parsed.path, parsed.query)
+            line, headers, body = _parse_message(files[response])
+            status, reason = (line.split(" ", 2) + [''])[1:3]
+            for name in _SKIPPED_HEADERS:
+                headers.pop(name, None)
+            self._responses.setdefault(key, []).append((int(status), reason,
+                                                        headers, body))
+
+    def lookup(self, method, host, path, query):
+        """Returns the next (status, reason, headers, body) response of
+        the request, or None if it was not recorded.
+        """
+        key = self.key(method, host, path, query)
+        responses = self._responses.get(key)
+        if not responses:
+            log.warn("no recorded response for %s %s%s?%s", method, host,
+                     path, query)
+            self.misses += 1
+            return None
+        with self._lock:
+            index = self._next.get(key, 0)
+            self._next[key] = (index + 1) % len(responses)
+        return responses[index]
+
+    def __len__(self):
+        return len(self._responses)
+
+
+# Stuff for the in process replay
+class ReplayHttpBase(object):
+    """Serves the requests from the replay_index instead of the network.
+
+    An unknown request gets a 404 response.
+    """
+    replay_index = None
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        parsed = urlparse.urlparse(request_uri)
+        response = self.replay_index.lookup(method, conn.host, parsed.path,
+                                            parsed.query)
+        if response is None:
+            response = 404, 'Not Recorded', {}, ''
+        status, reason, headers, content = response
+        info = dict(headers)
+        info['status'] = str(status)
+        info['content-length'] = str(len(content))
+        response = httplib2.Response(info)
+        response.reason = reason
+        return response, content
+
+
+# the recorders sit on top, so the replayed traffic can be captured too
+class ReplayHttplib2(RecordingHttpBase, ReplayHttpBase, httplib2.Http):
+    def __init__(self):
+        httplib2.Http.__init__(self)
+        RecordingHttpBase.__init__(self)
+
+
+class ReplayOauth2(RecordingHttpBase, ReplayHttpBase, oauth2.Client):
+    def __init__(self, *args, **kw):
+        oauth2.Client.__init__(self, *args, **kw)
+        RecordingHttpBase.__init__(self)
+
+
+@contextmanager
+def replaying(index):
+    """Makes the requestors of protocap serve their requests from
+    *index*, a ReplayIndex.
+    """
+    requestors = ((protocap.HttpRequestor, ReplayHttplib2),
+                  (protocap.OAuth2Requestor, ReplayOauth2))
+    saved = [(requestor, requestor.__dict__['pc_http_class'])
+             for requestor, klass in requestors]
+    for requestor, klass in requestors:
+        requestor.pc_http_class = type(klass.__name__, (klass,),
+                                       {'replay_index': index})
+    try:
+        yield index
+    finally:
+        for requestor, klass in saved:
+            requestor.pc_http_class = klass
+
+
+# Stuff for the local server
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Serves the requests of the ReplayServer.
+
+    The host of the request is the one of an absolute request uri (when
+    the server is used as a proxy), the server host if set, or the Host
+    header.
+    """
+    def _replay(self):
+        server = self.server
+        parsed = urlparse.urlparse(self.path)
+        host = parsed.netloc or server.host or self.headers.get('host', '')
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        response = server.index.lookup(self.command, host, parsed.path,
+                                       parsed.query)
+        if response is None:
+            self.send_error(404, 'Not Recorded')
+            return
+        status, reason, headers, body = response
+        self.send_response(status, reason)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _replay
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """Serves *index* on *address*, as if it was *host*.
+
+    The port is chosen by the system if 0, server_address holds the
+    actual one.
+    """
+    daemon_threads = True
+
+    def __init__(self, index, address=('127.0.0.1', 0), host=None):
+        HTTPServer.__init__(self, address, ReplayHandler)
+        self.index = index
+        self.host = host
+
+    def start(self):
+        """Serves the requests from a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print('Usage: replay captures_path [port]')
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    index = ReplayIndex(sys.argv[1])
+    port = len(sys.argv) == 3 and int(sys.argv[2]) or 8080
+    server = ReplayServer(index, ('127.0.0.1', port))
+    print('Serving %d requests on port %d.' % (len(index), port))
+    server.serve_forever()
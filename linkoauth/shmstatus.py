@@ -0,0 +1,219 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Services status kept in a memory-mapped file.
+
+This is meant for single-host deployments: the prefork workers, the
+middleware and the sstatus script share the counters through the file
+instead of a memcached server.
+
+The file starts with a header, followed by a fixed number of slots.  Each
+slot holds a service name, its enabled flag, and a ring of counter buckets
+(bucket number, successes, failures) like the CircuitBreaker ones.  The
+slot of a service is found by hashing its name.
+
+The writes are serialized with a lock on the file, the reads are plain
+memory reads.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from linkoauth.errors import StatusWriteError
+from linkoauth.sstatus import StatusBackend
+
+MAGIC = 'LKST'
+VERSION = 1
+# magic, version, slots, buckets, bucket width
+_HEADER = struct.Struct('<4sIIId')
+_NAME_SIZE = 64
+# service name, enabled flag
+_SLOT = struct.Struct('<%dsq' % _NAME_SIZE)
+# bucket number, successes, failures
+_BUCKET = struct.Struct('<qqq')
+
+
+class SharedMemoryBackend(StatusBackend):
+    """Status backend stored in the *path* file.
+
+    The file is created with room for *slots* services if it does not
+    exist.  All the processes using it must use the same window.
+    """
+    def __init__(self, path, services, window, slots=256):
+        self.path = path
+        self.window = window
+        self._slot_size = _SLOT.size + _BUCKET.size * window.size
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map = self._open(slots)
+                for service in services:
+                    self._offset(service, create=True)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _open(self, slots):
+        if os.fstat(self._fd).st_size == 0:
+            os.ftruncate(self._fd, _HEADER.size + slots * self._slot_size)
+            os.write(self._fd, _HEADER.pack(MAGIC, VERSION, slots,
+                                            self.window.size,
+                                            self.window.width))
+        mapped = mmap.mmap(self._fd, 0)
+        magic, version, slots, buckets, width = _HEADER.unpack_from(mapped)
+        if magic != MAGIC or version != VERSION:
+            mapped.close()
+            raise ValueError('%s is not a status file' % self.path)
+        if buckets != self.window.size or width != self.window.width:
+            mapped.close()
+            raise ValueError('%s uses %d buckets of %ss' % (self.path,
+                                                           buckets, width))
+        self.slots = slots
+        return mapped
+
+    @contextmanager
+    def _locked(self):
+        # the file lock is per process, so the threads need their own
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _offset(self, service, create=False):
+        """Returns the offset of the service slot.
+
+        When *create* is True the slot is claimed if needed, and the
+        caller must hold the lock.  Otherwise None is returned for an
+        unknown service.
+        """
+        offset = self._offsets.get(service)
+        if offset is not None:
+            return offset
+
+        name = service.encode('utf8')
+        if len(name) > _NAME_SIZE:
+            raise ValueError('Service name too long: %r' % service)
+        start = zlib.crc32(name) % self.slots
+        for index in range(self.slots):
+            offset = (_HEADER.size +
+                      ((start + index) % self.slots) * self._slot_size)
+            slot_name = _SLOT.unpack_from(self._map, offset)[0].rstrip('\0')
+            if slot_name == name:
+                self._offsets[service] = offset
+                return offset
+            if slot_name == '':
+                if not create:
+                    return None
+                self._reset(offset, name)
+                self._offsets[service] = offset
+                return offset
+
+        if create:
+            raise StatusWriteError('%s is full' % self.path)
+        return None
+
+    def _reset(self, offset, name):
+        _SLOT.pack_into(self._map, offset, name, 1)
+        for index in range(self.window.size):
+            _BUCKET.pack_into(self._map,
+                              offset + _SLOT.size + index * _BUCKET.size,
+                              -1, 0, 0)
+
+    def initialize(self, service):
+        with self._locked():
+            self._reset(self._offset(service, create=True),
+                        service.encode('utf8'))
+
+    def set_enabled(self, service, enabled):
+        with self._locked():
+            offset = self._offset(service, create=True)
+            name = _SLOT.unpack_from(self._map, offset)[0]
+            _SLOT.pack_into(self._map, offset, name, int(enabled))
+
+    def get_buckets(self, services):
+        numbers = self.window.numbers()
+        res = {}
+        for service in services:
+            offset = self._offset(service)
+            if offset is None:
+                res[service] = None, dict([(number, (0, 0))
+                                           for number in numbers])
+                continue
+            enabled = bool(_SLOT.unpack_from(self._map, offset)[1])
+            counts = {}
+            for number in numbers:
+                bucket, succ, fail = _BUCKET.unpack_from(self._map,
+                        offset + _SLOT.size +
+                        (number % self.window.size) * _BUCKET.size)
+                if bucket != number:
+                    succ = fail = 0
+                counts[number] = succ, fail
+            res[service] = enabled, counts
+        return res
+
+    def _incr(self, service, success, count, current):
+        offset = (self._offset(service, create=True) + _SLOT.size +
+                  (current % self.window.size) * _BUCKET.size)
+        number, succ, fail = _BUCKET.unpack_from(self._map, offset)
+        if number != current:
+            succ = fail = 0
+        if success:
+            succ += count
+        else:
+            fail += count
+        _BUCKET.pack_into(self._map, offset, current, succ, fail)
+        if success:
+            return succ
+        return fail
+
+    def incr(self, service, success, count=1):
+        current = int(time.time() / self.window.width)
+        with self._locked():
+            return self._incr(service, success, count, current)
+
+    def incr_multi(self, deltas):
+        current = int(time.time() / self.window.width)
+        pending = dict(deltas)
+        with self._locked():
+            for (service, success), count in deltas.items():
+                try:
+                    self._incr(service, success, count, current)
+                except StatusWriteError:
+                    raise StatusWriteError(unapplied=pending)
+                del pending[service, success]
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
@@ -45,150 +45,719 @@ This module provides:
 
 
 The statuses are saved in a membase backend that can be replicated around
-using the peer-to-peer replication feature.
+using the peer-to-peer replication feature.  Single-host deployments can
+keep them in shared memory instead, see linkoauth.shmstatus.
 """
+import abc
+import itertools
+import os
 import sys
+import json
+import math
+import random
+import time
+import logging
+import threading
+from contextlib import contextmanager
 from functools import wraps
+from optparse import OptionParser
 
-from pylibmc import Client, SomeErrors, WriteError
+from pylibmc import Client, ClientPool, SomeErrors, WriteError, Error
 from _pylibmc import NotFound
 
 from linkoauth.errors import StatusReadError, StatusWriteError
+from linkoauth.workers import BackgroundThread
+
+log = logging.getLogger(__name__)
+
+SHM_PREFIX = 'shm:'
 
 
 def _key(*args):
     return ':'.join(args)
 
 
+class CounterWindow(object):
+    """Time buckets of the success and failure counters.
+
+    Each counter is split in buckets of *width* seconds, and the buckets
+    covering the last *ttl* seconds are summed up, so the counts slide
+    with time instead of being reset when a key expires.
+
+    With *shards* > 1, each bucket is also split in *shards* keys, and
+    each thread increments one of them, so the writes of a busy service
+    are spread over the memcached servers.
+    """
+    def __init__(self, ttl, width=60, shards=1):
+        self.width = width
+        self.shards = shards
+        self._local = threading.local()
+        self._threads = itertools.count()
+        self.size = max(int(math.ceil(float(ttl) / width)), 1)
+        # a bucket must live as long as it's part of the window
+        self.ttl = int(math.ceil(ttl + width))
+
+    def _bucket(self, service, name, number):
+        return _key('service', service, name, str(number))
+
+    def numbers(self, now=None):
+        """Returns the numbers of the window buckets, the current one
+        first."""
+        if now is None:
+            now = time.time()
+        current = int(now / self.width)
+        return range(current, current - self.size, -1)
+
+    def bucket_keys(self, service, name, number):
+        """Returns the keys of a bucket, one per shard."""
+        key = self._bucket(service, name, number)
+        if self.shards == 1:
+            return [key]
+        return [_key(key, str(shard)) for shard in range(self.shards)]
+
+    def keys(self, service, name, now=None):
+        """Returns the keys of the window buckets, the current one first."""
+        keys = []
+        for number in self.numbers(now):
+            keys.extend(self.bucket_keys(service, name, number))
+        return keys
+
+    def write_key(self, service, name, now=None):
+        """Returns the key the current thread increments."""
+        if now is None:
+            now = time.time()
+        key = self._bucket(service, name, int(now / self.width))
+        if self.shards == 1:
+            return key
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            # the threads pick the shards in turn, starting at a different
+            # one in each process
+            shard = (os.getpid() + self._threads.next()) % self.shards
+            self._local.shard = shard
+        return _key(key, str(shard))
+
+
+def _sums(enabled, buckets):
+    """Returns the (enabled, successes, failures) of the buckets."""
+    counts = buckets.values()
+    return (enabled, sum([succ for succ, fail in counts]),
+            sum([fail for succ, fail in counts]))
+
+
 def cache_initialized(fn):
     @wraps(fn)
     def initializer(self, *args, **kwargs):
-        if getattr(self, '_initialized', False):
-            # already initialized, scrap the decorator
-            setattr(self, fn.__name__, fn)
-        else:
-            for service in self.services:
-                # initialize if not found
-                try:
-                    enabled = self._cache.get(_key('service', service, 'on'))
-                except SomeErrors:
-                    raise StatusReadError()
-                if enabled is None:
-                    self.initialize(service)
+        if not self._initialized:
+            self.setup()
         return fn(self, *args, **kwargs)
     return initializer
 
 
 class ServicesStatusCache(object):
-    """Thin wrapper around cache client to allow for graceful initialization"""
-    def __init__(self, servers, services, ttl, binary):
+    """Thin wrapper around cache client to allow for graceful initialization
+
+    The services that are not in the cache yet are set up on first use,
+    once per process.
+
+    A client is not thread-safe, so each call reserves one from a pool of
+    *pool_size* clones.  The pool is created again in a child process
+    after a fork, so the connections are not shared with the parent.
+    """
+    def __init__(self, servers, services, window, binary, pool_size=10):
         self.services = services
-        self.ttl = ttl
-        self._cache = Client(servers, binary=binary)
-        self._cache.behaviors = {"no_block": True}
+        self.window = window
+        self.pool_size = pool_size
+        self._master = Client(servers, binary=binary)
+        self._master.behaviors = {"no_block": True}
+        self._pool = None
+        self._pid = None
+        self._pool_lock = threading.Lock()
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        pid = os.getpid()
+        if self._pool is None or self._pid != pid:
+            with self._pool_lock:
+                if self._pool is None or self._pid != pid:
+                    self._pool = ClientPool(self._master, self.pool_size)
+                    self._pid = pid
+        return self._pool
+
+    @contextmanager
+    def _client(self):
+        # waits for a client if they are all in use
+        with self._get_pool().reserve(block=True) as client:
+            yield client
+
+    def _counters(self, service):
+        counters = {}
+        for name in ('succ', 'fail'):
+            for key in self.window.keys(service, name):
+                counters[key] = 0
+        return counters
+
+    def setup(self):
+        """Sets up the services missing from the cache.
+
+        The services are looked up with a single get_multi call, and the
+        missing ones are added so the values set by another process in the
+        meantime are kept.
+        """
+        with self._lock:
+            if self._initialized:
+                return
+            keys = [_key('service', service, 'on')
+                    for service in self.services]
+            with self._client() as client:
+                try:
+                    found = client.get_multi(keys)
+                except SomeErrors:
+                    raise StatusReadError()
+
+                missing = [service for service, key
+                           in zip(self.services, keys)
+                           if found.get(key) is None]
+                if missing:
+                    counters = {}
+                    for service in missing:
+                        counters.update(self._counters(service))
+                    try:
+                        client.add_multi(dict([(_key('service', service,
+                                                     'on'), True)
+                                               for service in missing]))
+                        client.add_multi(counters, time=self.window.ttl)
+                    except WriteError:
+                        raise StatusWriteError()
+            self._initialized = True
 
     def initialize(self, service):
-        # XXX see if one key is better wrt R/W numbers
-        # to do a single memcached call here
+        # the counters of the whole window are reset
+        counters = self._counters(service)
         try:
-            self._cache.set(_key('service', service, 'on'), True)
-            self._cache.set(_key('service', service, 'succ'), 0,
-                            time=self.ttl)
-            self._cache.set(_key('service', service, 'fail'), 0,
-                            time=self.ttl)
+            with self._client() as client:
+                client.set(_key('service', service, 'on'), True)
+                client.set_multi(counters, time=self.window.ttl)
             return True
         except WriteError:
             raise StatusWriteError()
 
     @cache_initialized
     def get(self, key):
-        return self._cache.get(key)
+        with self._client() as client:
+            return client.get(key)
+
+    @cache_initialized
+    def get_multi(self, keys):
+        with self._client() as client:
+            return client.get_multi(keys)
 
     @cache_initialized
     def set(self, key, *args, **kwargs):
-        return self._cache.set(key, *args, **kwargs)
+        with self._client() as client:
+            return client.set(key, *args, **kwargs)
 
     @cache_initialized
-    def incr(self, key):
-        return self._cache.incr(key)
+    def set_multi(self, mapping, **kwargs):
+        with self._client() as client:
+            return client.set_multi(mapping, **kwargs)
 
+    @cache_initialized
+    def incr(self, key, delta=1):
+        with self._client() as client:
+            return client.incr(key, delta)
 
-class ServicesStatus(object):
+    @cache_initialized
+    def add(self, key, *args, **kwargs):
+        with self._client() as client:
+            return client.add(key, *args, **kwargs)
 
-    def __init__(self, services, servers=None, ttl=600):
-        self.ttl = ttl
-        if servers is None:
-            servers = ['127.0.0.1:11211']
-        self._cache = ServicesStatusCache(servers, services, ttl, binary=True)
+    @cache_initialized
+    def add_multi(self, mapping, **kwargs):
+        with self._client() as client:
+            return client.add_multi(mapping, **kwargs)
+
+    @cache_initialized
+    def incr_multi(self, keys, delta=1):
+        with self._client() as client:
+            return client.incr_multi(keys, delta=delta)
+
+
+class CounterBuffer(object):
+    """Accumulates counter deltas in memory.
+
+    The deltas are passed to *flush* from a background thread every
+    *interval* seconds, or as soon as *size* increments are pending.
+    """
+    def __init__(self, flush, interval=1., size=100):
+        self._flush = flush
+        self.interval = interval
+        self.size = size
+        self._deltas = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # started on first use, and again after a fork
+        self._thread = BackgroundThread(self._run)
+
+    def add(self, key, delta=1):
+        with self._lock:
+            self._deltas[key] = self._deltas.get(key, 0) + delta
+            self._pending += delta
+            full = self._pending >= self.size
+        self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Passes the pending deltas to the flush callable."""
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+            self._pending = 0
+        if not deltas:
+            return
+        try:
+            self._flush(deltas)
+        except Exception, e:
+            log.exception("could not flush the counters")
+            # keep the deltas not applied for the next flush
+            if getattr(e, 'unapplied', None) is not None:
+                deltas = e.unapplied
+            with self._lock:
+                for key, delta in deltas.items():
+                    self._deltas[key] = self._deltas.get(key, 0) + delta
+
+
+class StatusBackend(object):
+    """Storage of the services status.
+
+    The success and failure counters are kept in the buckets of a
+    CounterWindow, its *window* attribute.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def initialize(self, service):
+        """Enables the service and resets its counters."""
+
+    @abc.abstractmethod
+    def set_enabled(self, service, enabled):
+        """Enables or disables the service."""
+
+    @abc.abstractmethod
+    def get_buckets(self, services):
+        """Returns {service: (enabled, buckets)}.
+
+        *buckets* maps the number of each bucket of the window to its
+        (successes, failures).  *enabled* is None for an unknown service.
+        """
+
+    def get_statuses(self, services):
+        """Returns {service: (enabled, successes, failures)}."""
+        return dict([(service, _sums(enabled, buckets))
+                     for service, (enabled, buckets)
+                     in self.get_buckets(services).items()])
+
+    @abc.abstractmethod
+    def incr(self, service, success, count=1):
+        """Adds *count* successes or failures to the current bucket.
+
+        Returns the new value of the bucket.
+        """
+
+    def incr_multi(self, deltas):
+        """Applies the {(service, success): count} deltas.
+
+        When some of them can't be applied, a StatusWriteError is raised
+        with the deltas that were not applied.
+        """
+        pending = dict(deltas)
+        for (service, success), count in deltas.items():
+            try:
+                self.incr(service, success, count)
+            except StatusWriteError:
+                raise StatusWriteError(unapplied=pending)
+            del pending[service, success]
+
+
+class MemcacheBackend(StatusBackend):
+    """Keeps the status in memcached, one key per counter bucket."""
+
+    def __init__(self, servers, services, window, pool_size=10):
+        self.window = window
+        self._cache = ServicesStatusCache(servers, services, window,
+                                          binary=True, pool_size=pool_size)
 
     def initialize(self, service):
         self._cache.initialize(service)
 
-    def enable(self, service):
+    def set_enabled(self, service, enabled):
         try:
-            self._cache.set(_key('service', service, 'on'), True)
+            self._cache.set(_key('service', service, 'on'), enabled)
         except WriteError:
             raise StatusWriteError()
 
-    def disable(self, service):
+    def get_buckets(self, services):
+        # all the statuses are read with a single get_multi call
+        numbers = self.window.numbers()
+        keys = {}
+        all_keys = []
+        for service in services:
+            on = _key('service', service, 'on')
+            buckets = [(number,
+                        self.window.bucket_keys(service, 'succ', number),
+                        self.window.bucket_keys(service, 'fail', number))
+                       for number in numbers]
+            keys[service] = on, buckets
+            all_keys.append(on)
+            for number, succ, fail in buckets:
+                all_keys.extend(succ)
+                all_keys.extend(fail)
         try:
-            self._cache.set(_key('service', service, 'on'), False)
+            values = self._cache.get_multi(all_keys)
+        except SomeErrors:
+            # could not read the status
+            raise StatusReadError()
+
+        res = {}
+        for service, (on, buckets) in keys.items():
+            counts = {}
+            for number, succ, fail in buckets:
+                counts[number] = (sum([values.get(key) or 0 for key in succ]),
+                                  sum([values.get(key) or 0 for key in fail]))
+            # the cache is only set up once, so a flag lost to a restart or
+            # an eviction reads as the default: enabled
+            res[service] = values.get(on, True), counts
+        return res
+
+    def incr(self, service, success, count=1):
+        name = success and 'succ' or 'fail'
+        key = self.window.write_key(service, name)
+        try:
+            try:
+                return self._cache.incr(key, count)
+            except NotFound:
+                # first hit in this bucket, unless another process just
+                # created it.
+                if self._cache.add(key, count, time=self.window.ttl):
+                    return count
+                return self._cache.incr(key, count)
         except WriteError:
             raise StatusWriteError()
 
-    def get_status(self, service):
+    def incr_multi(self, deltas):
+        # missing counters are created first, so the increments of all
+        # the services can be sent in one call per delta value.
+        now = time.time()
+        seeds = {}
+        keys_by_delta = {}
+        for (service, success), delta in deltas.items():
+            succ = self.window.write_key(service, 'succ', now)
+            fail = self.window.write_key(service, 'fail', now)
+            seeds[succ] = seeds[fail] = 0
+            keys_by_delta.setdefault(delta, {})[success and succ
+                                                or fail] = service, success
+        pending = dict(deltas)
         try:
-            enabled = self._cache.get(_key('service', service, 'on'))
-            succ = self._cache.get(_key('service', service, 'succ'))
-            if succ is None:
-                succ = 0
+            self._cache.add_multi(seeds, time=self.window.ttl)
+            for delta, keys in keys_by_delta.items():
+                # a failed call may have applied some of its increments,
+                # they are counted again on the next flush
+                self._cache.incr_multi(keys.keys(), delta=delta)
+                for counter in keys.values():
+                    del pending[counter]
+        except Error:
+            raise StatusWriteError(unapplied=pending)
+
+
+def get_backend(servers, services, window, pool_size=10):
+    """Returns the status backend for *servers*.
+
+    A single "shm:<path>" server selects the shared memory backend, stored
+    in the <path> file.  Anything else is a list of memcached servers,
+    used through a pool of *pool_size* clients.
+    """
+    if servers is None:
+        servers = ['127.0.0.1:11211']
+    elif isinstance(servers, basestring):
+        servers = [servers]
+    if len(servers) == 1 and servers[0].startswith(SHM_PREFIX):
+        from linkoauth.shmstatus import SharedMemoryBackend
+        return SharedMemoryBackend(servers[0][len(SHM_PREFIX):], services,
+                                   window)
+    return MemcacheBackend(servers, services, window, pool_size)
 
-            fail = self._cache.get(_key('service', service, 'fail'))
-            if fail is None:
-                fail = 0
 
-            return enabled, succ, fail
-        except SomeErrors:
-            # could not read the status
-            raise StatusReadError()
-
-    def update_status(self, service, success):
-        if success:
-            key = _key('service', service, 'succ')
-            other_key = _key('service', service, 'fail')
+class ServicesStatus(object):
+    """Reads and writes the services status.
+
+    The success and failure counters cover the last *ttl* seconds, in
+    buckets of *bucket_width* seconds.  With *shards* > 1, the counters
+    of each bucket are spread over that many memcached keys (see
+    CounterWindow).  All the processes sharing the counters must use the
+    same bucket width and number of shards.
+
+    The status is kept in memcached, or in shared memory if *servers* is
+    "shm:<path>" (see get_backend).  A StatusBackend can also be passed
+    as *backend*.  *pool_size* is the number of memcached clients, i.e.
+    the number of threads that can reach memcached at the same time.
+
+    When *flush_interval* is set, update_status only buffers the counter
+    increments in memory, and they are written to the backend in bulk
+    every *flush_interval* seconds, or as soon as *flush_size* increments
+    are pending.
+    """
+
+    def __init__(self, services, servers=None, ttl=600, flush_interval=None,
+                 flush_size=100, bucket_width=60, backend=None,
+                 pool_size=10, shards=1):
+        self.ttl = ttl
+        if backend is None:
+            backend = get_backend(servers, services,
+                                  CounterWindow(ttl, bucket_width, shards),
+                                  pool_size)
+        self._backend = backend
+        self.window = backend.window
+        if flush_interval is None:
+            self._buffer = None
         else:
-            key = _key('service', service, 'fail')
-            other_key = _key('service', service, 'succ')
+            self._buffer = CounterBuffer(self._backend.incr_multi,
+                                         flush_interval, flush_size)
 
+    def initialize(self, service):
+        self._backend.initialize(service)
+
+    def enable(self, service):
+        self._backend.set_enabled(service, True)
+
+    def disable(self, service):
+        self._backend.set_enabled(service, False)
+
+    def get_status(self, service):
+        return self.get_statuses([service])[service]
+
+    def flush(self):
+        """Writes the buffered counter increments, if any."""
+        if self._buffer is not None:
+            self._buffer.flush()
+
+    def get_statuses(self, services):
+        """Returns {service: (enabled, successes, failures)}.
+
+        The successes and failures are the sums over the window.
+        """
+        return self._backend.get_statuses(services)
+
+    def get_buckets(self, services):
+        """Returns {service: (enabled, buckets)}.
+
+        *buckets* maps the number of each bucket of the window to its
+        (successes, failures).
+        """
+        return self._backend.get_buckets(services)
+
+    def update_status(self, service, success, count=1):
+        """Adds *count* successes or failures to the counters of a service.
+
+        Returns the new value of the current bucket, or None in buffered
+        mode.
+        """
+        if self._buffer is not None:
+            self._buffer.add((service, bool(success)), count)
+            return None
+        return self._backend.incr(service, success, count)
+
+
+class StatusPoller(object):
+    """Keeps an in-memory copy of the services status.
+
+    A background thread reads the buckets of all the services every
+    *interval* seconds.  When a read fails, whatever the error, the last
+    buckets read are kept and the thread goes on.
+    """
+    def __init__(self, checker, services, interval):
+        self._checker = checker
+        self.services = services
+        self.interval = interval
+        self._statuses = None
+        self._lock = threading.Lock()
+        # started on first use, and again after a fork
+        self._thread = BackgroundThread(self._run)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.refresh()
+
+    def refresh(self):
+        """Reads the statuses.  Returns False if they could not be read."""
         try:
-            return self._cache.incr(key)
-        except NotFound:
-            # the key ttl-ed
-            self._cache.set(key, 1, time=self.ttl)
-            self._cache.set(other_key, 0, time=self.ttl)
-            return 1
-        except WriteError:
-            raise StatusWriteError()
+            statuses = self._checker.get_buckets(self.services)
+        except StatusReadError:
+            log.warning("could not refresh the services status")
+            return False
+        except Exception:
+            # the background thread must survive anything
+            log.exception("could not refresh the services status")
+            return False
+        self._statuses = statuses
+        return True
+
+    def get_status(self, service):
+        """Returns the last (enabled, buckets) read, or None if it never
+        was."""
+        self._thread.start()
+        if self._statuses is None:
+            # first call, the statuses are read once synchronously
+            self.refresh()
+        if self._statuses is None:
+            return None
+        return self._statuses.get(service)
+
+
+def _probed(previous, current):
+    """Returns True if a probe went through between two reads of the
+    (number, successes) of the current bucket."""
+    if previous is None:
+        return current[1] > 0
+    if current[0] == previous[0]:
+        return current[1] > previous[1]
+    # a new bucket started since
+    return current[0] > previous[0] and current[1] > 0
 
 
 class ServicesStatusMiddleware(object):
+    """Rejects the requests targeting a service that is down.
+
+    When the successes/failures ratio of a service falls below its
+    treshold, the requests are rejected with a probability that grows as
+    the ratio gets further from the treshold.  At least *probe_rate* of the
+    requests always go through: they probe the provider, and as it heals
+    the ratio climbs back and more requests are let through.
+
+    The Retry-After of the rejected requests is the time left until the
+    oldest bucket of the window expires, doubled for each bucket width
+    the outage lasted without a successful probe, up to *retry_after*
+    seconds.  It's jittered so the clients don't all come back at once.
+    The probes are told from the successes of the current bucket, as the
+    window total drops when a bucket expires.
+    A disabled service always gets *retry_after*.
+
+    If *refresh_interval* is set, the status is read from memory and
+    refreshed in the background every *refresh_interval* seconds, instead
+    of being read from the cache on each request.
+
+    If *metrics* is provided, a GET on *metrics_path* returns its
+    snapshot() as JSON, e.g. the metrics of a Services instance.
+
+    *cache_ttl*, *cache_bucket_width* and *cache_shards* must match the
+    ones of the Services writing the counters.
+    """
 
     def __init__(self, app, services, tresholds, retry_after=600,
-                 cache_servers=None):
+                 cache_servers=None, metrics=None,
+                 metrics_path='/__metrics__', refresh_interval=None,
+                 probe_rate=0.05, cache_pool_size=10, cache_shards=1,
+                 cache_ttl=600, cache_bucket_width=60):
         self.app = app
         self.services = services
         self.tresholds = tresholds
         self.retry_after = retry_after
-        self._status_checker = ServicesStatus(services, cache_servers)
-
-    def _503(self, start_response):
+        self.probe_rate = probe_rate
+        self.metrics = metrics
+        self.metrics_path = metrics_path
+        self._status_checker = ServicesStatus(services, cache_servers,
+                                              ttl=cache_ttl,
+                                              bucket_width=cache_bucket_width,
+                                              pool_size=cache_pool_size,
+                                              shards=cache_shards)
+        # service -> [start, (bucket, successes), last successful probe]
+        self._outages = {}
+        self._lock = threading.Lock()
+        if refresh_interval is None:
+            self._poller = None
+        else:
+            self._poller = StatusPoller(self._status_checker, services,
+                                        refresh_interval)
+
+    def _get_status(self, service):
+        """Returns (enabled, successes, failures, current), *current*
+        being the (number, successes) of the current bucket or None."""
+        if self._poller is not None:
+            status = self._poller.get_status(service)
+        else:
+            try:
+                status = self._status_checker.get_buckets([service])[service]
+            except StatusReadError:
+                status = None
+        if status is None:
+            # could not read the status
+            return True, 0, 0, None
+        enabled, buckets = status
+        current = max(buckets)
+        return _sums(enabled, buckets) + ((current, buckets[current][0]),)
+
+    def _shed(self, ratio, treshold):
+        """Returns True if the request must be rejected."""
+        if ratio >= treshold:
+            return False
+        probability = min(1. - ratio / treshold, 1. - self.probe_rate)
+        return random.random() < probability
+
+    def _retry_after(self, service, current):
+        """Returns the Retry-After of a shed request, in seconds.
+
+        *current* is the (number, successes) of the current bucket.
+        """
+        now = time.time()
+        with self._lock:
+            outage = self._outages.get(service)
+            if outage is None:
+                outage = self._outages[service] = [now, current, now]
+            elif current is not None and _probed(outage[1], current):
+                outage[2] = now
+            if current is not None:
+                outage[1] = current
+            start, probed = outage[0], outage[2]
+
+        width = self._status_checker.window.width
+        delay = width - now % width
+        if now - probed >= width:
+            # no successful probe lately, back off as the outage lasts
+            delay *= 2 ** min(int((now - start) / width), 16)
+        delay = min(delay, self.retry_after)
+        delay = delay / 2. + random.uniform(0, delay / 2.)
+        return max(int(math.ceil(delay)), 1)
+
+    def _metrics(self, start_response):
+        body = json.dumps(self.metrics.snapshot())
+        headers = [('Content-Type', 'application/json'),
+                   ('Content-Length', str(len(body)))]
+        start_response('200 OK', headers)
+        return [body]
+
+    def _503(self, start_response, retry_after=None):
+        if retry_after is None:
+            retry_after = self.retry_after
         headers = [('Content-Type', 'text/plain'),
-                   ('Retry-After', str(self.retry_after))]
+                   ('Retry-After', str(retry_after))]
 
         start_response('503 Service Unavailable', headers)
         return ['The service is unavailable']
 
     def __call__(self, environ, start_response):
+        if (self.metrics is not None and
+            environ.get('PATH_INFO') == self.metrics_path and
+            environ.get('REQUEST_METHOD', 'GET') == 'GET'):
+            return self._metrics(start_response)
+
         target_service = environ.get('HTTP_X_TARGET_DOMAIN')
         try:
             index = self.services.index(target_service)
@@ -196,26 +765,30 @@ class ServicesStatusMiddleware(object):
             index = -1
 
         if index != -1:
-            try:
-                on, succ, fail = \
-                    self._status_checker.get_status(target_service)
-            except StatusReadError:
-                # could not read the status
-                on, succ, fail = True, 0, 0
+            on, succ, fail, current = self._get_status(target_service)
 
             if not on:
                 return self._503(start_response)
 
-            if fail != 0:
-                ratio = float(succ) / float(fail)
-                if ratio < self.tresholds[index]:
-                    return self._503(start_response)
+            ratio = fail and float(succ) / float(fail)
+            if fail != 0 and ratio < self.tresholds[index]:
+                if self._shed(ratio, self.tresholds[index]):
+                    retry_after = self._retry_after(target_service,
+                                                    current)
+                    return self._503(start_response, retry_after)
+            elif target_service in self._outages:
+                with self._lock:
+                    self._outages.pop(target_service, None)
 
         return self.app(environ, start_response)
 
 
 _USAGE = """\
-Usage : sstatus server domain action [options]
+Usage : sstatus [options] server domain action
+        sstatus [options] server --all status
+
+The server is a memcached server, or shm:<path> for the shared memory
+status file used by the application.
 
 Available actions:
     - status: returns a status for the domain
@@ -223,43 +796,176 @@ Available actions:
     - disable: disable the domain
     - reset: reset the domain by setting the counters to 0 and enabling it
 
+With --all, the status of all the registered domains is read at once.
+With --watch, the status is read again every --interval seconds, with the
+successes and failures per second since the previous read.
+
+The --ttl, --bucket-width and --shards options must match the ones of
+the application.
+
 Example:
 
     $ sstatus 127.0.0.1:11211 google.com status
     This service is enabled.
     12653 successes, 3 failures.
 
+    $ sstatus --all --watch --json 127.0.0.1:11211 status
 """
 
+
 def _ask(question):
     answer = raw_input(question + ' ')
     answer = answer.lower().strip()
     return answer in ('y', 'yes')
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 4:
-        print(_USAGE)
-        sys.exit(1)
+def _registered_domains():
+    from linkoauth.backends import Requester
+    return sorted([requester.get_name()
+                   for requester in Requester._abc_registry])
+
+
+def _new_counts(buckets, previous):
+    """Returns the (successes, failures) added to *buckets* since the
+    *previous* read.
+
+    The buckets which left the window since are ignored, and the ones
+    which entered it are new as a whole.
+    """
+    succ = fail = 0
+    for number, (bsucc, bfail) in buckets.items():
+        psucc, pfail = previous.get(number, (0, 0))
+        succ += max(bsucc - psucc, 0)
+        fail += max(bfail - pfail, 0)
+    return succ, fail
+
+
+def _status_dict(status, new=None, elapsed=None):
+    enabled, success, fail = status
+    res = {'enabled': bool(enabled), 'successes': success,
+           'failures': fail}
+    if new is not None:
+        res['successes_per_second'] = new[0] / elapsed
+        res['failures_per_second'] = new[1] / elapsed
+    return res
+
+
+def _print_statuses(statuses, new=None, elapsed=None):
+    print('%-20s %-8s %10s %10s %9s %9s' % ('domain', 'status', 'successes',
+                                             'failures', 'succ/s', 'fail/s'))
+    for domain in sorted(statuses):
+        status = _status_dict(statuses[domain], new and new.get(domain),
+                              elapsed)
+        line = '%-20s %-8s %10d %10d' % (domain, status['enabled'] and 'on'
+                                         or 'off', status['successes'],
+                                         status['failures'])
+        if 'successes_per_second' in status:
+            line += ' %9.2f %9.2f' % (status['successes_per_second'],
+                                      status['failures_per_second'])
+        print(line)
+
+
+def _watch(server, domains, interval, as_json):
+    # one multi-get per round, the rates are computed from the buckets
+    # as the window totals drop when a bucket expires
+    previous = last = None
+    while True:
+        try:
+            buckets = server.get_buckets(domains)
+        except StatusReadError:
+            print('Ooops, could not read the status.')
+            buckets = None
+
+        if buckets is not None:
+            now = time.time()
+            elapsed = last and now - last
+            statuses = dict([(domain, _sums(enabled, counts))
+                             for domain, (enabled, counts)
+                             in buckets.items()])
+            new = None
+            if previous is not None:
+                new = dict([(domain,
+                             _new_counts(counts,
+                                         previous.get(domain, (None, {}))[1]))
+                            for domain, (enabled, counts)
+                            in buckets.items()])
+            if as_json:
+                print(json.dumps({'time': now, 'services':
+                                  dict([(domain,
+                                         _status_dict(status,
+                                                      new and new[domain],
+                                                      elapsed))
+                                        for domain, status
+                                        in statuses.items()])}))
+            else:
+                print(time.strftime('%Y-%m-%d %H:%M:%S',
+                                    time.localtime(now)))
+                _print_statuses(statuses, new, elapsed)
+                print('')
+            sys.stdout.flush()
+            previous, last = buckets, now
+        time.sleep(interval)
+
+
+def main(args=None):
+    parser = OptionParser(usage=_USAGE)
+    parser.add_option('--all', action='store_true', default=False,
+                      help='read the status of all the domains')
+    parser.add_option('--watch', action='store_true', default=False,
+                      help='read the status continuously')
+    parser.add_option('--interval', type='float', default=5.,
+                      help='seconds between two reads in watch mode')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='JSON output')
+    parser.add_option('--ttl', type='int', default=600,
+                      help='length of the counters window, in seconds')
+    parser.add_option('--bucket-width', type='float', default=60,
+                      help='width of the counters buckets, in seconds')
+    parser.add_option('--shards', type='int', default=1,
+                      help='number of shards of the counters')
+    options, args = parser.parse_args(args)
+
+    if options.all:
+        if len(args) != 2 or args[1] != 'status':
+            parser.error('--all only reads the status')
+        server, action = args
+        domains = _registered_domains()
+    elif len(args) != 3:
+        parser.error('wrong number of arguments')
+    else:
+        server, domain, action = args
+        domains = [domain]
 
-    server = sys.argv[1]
-    domain = sys.argv[2]
-    action = sys.argv[3]
-    options = sys.argv[4:]
+    if options.watch and action != 'status':
+        parser.error('--watch only reads the status')
 
-    server = ServicesStatus([domain], [server])
-    if action == 'status':
+    server = ServicesStatus(domains, [server], ttl=options.ttl,
+                            bucket_width=options.bucket_width,
+                            shards=options.shards)
+    if options.watch:
+        try:
+            _watch(server, domains, options.interval, options.json)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    elif action == 'status':
         try:
-            enabled, success, fail = server.get_status(domain)
+            statuses = server.get_statuses(domains)
         except StatusReadError:
             print('Ooops, could not read the status.')
             sys.exit(1)
 
-        if not enabled:
-            print('This service has been disabled')
+        if options.json:
+            print(json.dumps(dict([(domain, _status_dict(status))
+                                   for domain, status in statuses.items()])))
+        elif options.all:
+            _print_statuses(statuses)
         else:
-            print('This service is enabled.')
-            print('%d successes, %d failures.' % (success, fail))
+            enabled, success, fail = statuses[domain]
+            if not enabled:
+                print('This service has been disabled')
+            else:
+                print('This service is enabled.')
+                print('%d successes, %d failures.' % (success, fail))
         sys.exit(0)
     elif action == 'enable':
         try:
@@ -296,5 +1002,9 @@ if __name__ == '__main__':
         sys.exit(0)
     else:
         print('Unknown action.')
-        print(usage)
+        print(_USAGE)
         sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,14 @@ import unittest
 import httplib2
 import json
 import mock
+import threading
 import time
 import urllib2
 
 from linkoauth.util import setup_config
+from linkoauth.util import config as utilconfig
 from linkoauth.backends import google_
-from linkoauth import Services
+from linkoauth import Services, AsyncServices
 from linkoauth import sstatus
 from linkoauth.errors import DomainNotRegisteredError
 
@@ -70,6 +72,9 @@ class MockCache(object):
         self._cache = dict()
         self._cache_ttl = dict()
 
+    def clone(self):
+        return self
+
     def get(self, key):
         if key in self._cache_ttl:
             now = time.time()
@@ -81,14 +86,42 @@ class MockCache(object):
                 self._cache_ttl[key] = (ttl, now)
         return self._cache.get(key)
 
+    def get_multi(self, keys):
+        res = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                res[key] = value
+        return res
+
     def set(self, key, value, **kwargs):
         self._cache[key] = value
         ttl = kwargs.get('time')
         if ttl is not None:
             self._cache_ttl[key] = (ttl, time.time())
 
-    def incr(self, key):
-        self._cache[key] = self._cache[key] + 1
+    def set_multi(self, mapping, **kwargs):
+        for key, value in mapping.items():
+            self.set(key, value, **kwargs)
+
+    def add(self, key, value, **kwargs):
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, **kwargs)
+        return True
+
+    def incr(self, key, delta=1):
+        if self.get(key) is None:
+            raise sstatus.NotFound()
+        self._cache[key] = self._cache[key] + delta
+
+    def add_multi(self, mapping, **kwargs):
+        for key, value in mapping.items():
+            self.add(key, value, **kwargs)
+
+    def incr_multi(self, keys, delta=1):
+        for key in keys:
+            self.incr(key, delta)
 
 
 class TestBasics(unittest.TestCase):
@@ -157,3 +190,249 @@ class TestBasics(unittest.TestCase):
 
         status = services.get_status('google.com')
         self.assertEquals(status, (True, 0, 0))
+
+    def test_sendmessage_many(self):
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+        messages = [('message %d' % i, args, None) for i in range(5)]
+
+        services = Services(['google.com'])
+        services.initialize('google.com')
+        results = services.sendmessage_many('google.com', _ACCOUNT, messages,
+                                            max_workers=2)
+
+        self.assertEqual(len(results), 5)
+        for res, error in results:
+            self.assertEqual(error, None)
+            self.assertEqual(res, {'status': 'message sent'})
+
+        status = services.get_status('google.com')
+        self.assertEquals(status, (True, 5, 0))
+
+        # an exception is returned as an error
+        class _Requester(object):
+            def sendmessage(self, message, options, headers):
+                raise ValueError('broken')
+
+        with mock.patch.object(services, '_get_requester',
+                               return_value=_Requester()):
+            results = services.sendmessage_many('google.com', _ACCOUNT,
+                                                messages[:1])
+        self.assertEqual(results, [(None, {'provider': 'google.com',
+                                           'message': 'broken',
+                                           'status': 500})])
+
+    def test_async(self):
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+
+        services = AsyncServices(['google.com'], async_workers=3)
+        self.assertEqual(services._async_workers.size, 3)
+        self.assertFalse(services._async_workers is services._workers)
+        services.initialize('google.com')
+        pending = [services.sendmessage('google.com', _ACCOUNT, '', args,
+                                        None) for i in range(3)]
+
+        for call in pending:
+            res, error = call.get(timeout=5)
+            self.assertEqual(res, {'status': 'message sent'})
+
+        status = services.get_status('google.com')
+        self.assertEquals(status, (True, 3, 0))
+
+    def test_iter_contacts(self):
+        pages = {0: ({'entry': [{'displayName': 'a'}, {'displayName': 'b'}],
+                      'pageData': {'start': 2}}, None),
+                 2: ({'entry': [{'displayName': 'c'}],
+                      'pageData': {'start': 3}}, None),
+                 3: ({'entry': []}, None)}
+        calls = []
+
+        class _Requester(object):
+            def getcontacts(self, options, headers):
+                calls.append(options)
+                return pages[options.get('start', 0)]
+
+        services = Services(['google.com'])
+        services.initialize('google.com')
+        with mock.patch.object(services, '_get_requester',
+                               return_value=_Requester()):
+            contacts = services.iter_contacts('google.com', _ACCOUNT)
+            names = [entry['displayName'] for entry in contacts]
+
+        self.assertEqual(names, ['a', 'b', 'c'])
+        self.assertEqual(calls, [{}, {'start': 2}, {'start': 3}])
+        status = services.get_status('google.com')
+        self.assertEquals(status, (True, 3, 0))
+
+    def test_broadcast(self):
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+
+        services = Services(['google.com'])
+        services.initialize('google.com')
+        targets = {'google.com': (_ACCOUNT, args),
+                   'a': (_ACCOUNT, args)}
+        results = services.broadcast('', targets, timeout=5)
+
+        res, error = results['google.com']
+        self.assertEqual(res, {'status': 'message sent'})
+        self.assertEqual(error, None)
+
+        # 'a' is not registered
+        res, error = results['a']
+        self.assertEqual(res, None)
+        self.assertEqual(error, {'provider': 'a', 'message': 'a',
+                                 'status': 404})
+
+        status = services.get_status('google.com')
+        self.assertEquals(status, (True, 1, 0))
+
+        # a provider which doesn't answer in time
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        class _Requester(object):
+            def sendmessage(self, message, options, headers):
+                release.wait()
+                return {'status': 'message sent'}, None
+
+        with mock.patch.object(services, '_get_requester',
+                               return_value=_Requester()):
+            results = services.broadcast('', {'google.com': (_ACCOUNT, args)},
+                                         timeout=0.1)
+        self.assertEqual(results['google.com'],
+                         (None, {'provider': 'google.com',
+                                 'message': 'timed out', 'status': 504}))
+
+    def test_broadcast_hanging(self):
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        class _Requester(object):
+            def __init__(self, domain):
+                self.domain = domain
+
+            def sendmessage(self, message, options, headers):
+                if self.domain == 'yahoo.com':
+                    release.wait()
+                return {'status': 'message sent'}, None
+
+        services = Services(['google.com', 'yahoo.com'], workers=2,
+                            broadcast_workers=2)
+        targets = {'google.com': (_ACCOUNT, args),
+                   'yahoo.com': (_ACCOUNT, args)}
+        with mock.patch.object(services, '_get_requester',
+                               lambda domain, account: _Requester(domain)):
+            for i in range(5):
+                results = services.broadcast('', targets, timeout=0.1)
+                # the sends left hanging don't hold up the other domains
+                self.assertEqual(results['google.com'],
+                                 ({'status': 'message sent'}, None))
+
+            # yahoo.com fails fast once its pool is busy
+            self.assertEqual(results['yahoo.com'][1]['status'], 503)
+            self.assertEqual(services._broadcasting['yahoo.com'], 2)
+
+            # and the shared pool is still free
+            self.assertEqual(services.sendmessage_many('google.com',
+                                                       _ACCOUNT,
+                                                       [('', args, None)]),
+                             [({'status': 'message sent'}, None)])
+
+            release.set()
+            services._broadcast_pools['yahoo.com'].close()
+        self.assertEqual(services._broadcasting['yahoo.com'], 0)
+
+    def test_bulkhead(self):
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+        config = dict(_CONFIG)
+        config['oauth.google.com.max_concurrency'] = '1'
+        setup_config(config)
+
+        services = Services(['google.com'])
+        services.initialize('google.com')
+        bulkhead = services._get_bulkhead('google.com')
+        self.assertEqual(bulkhead.max_concurrency, 1)
+
+        # kept across per-request configurations...
+        copy = dict(config)
+        copy['debug'] = 'true'
+        utilconfig.push_thread_config(copy)
+        try:
+            self.assertTrue(services._get_bulkhead('google.com') is bulkhead)
+        finally:
+            utilconfig.pop_thread_config(copy)
+
+        # ...but rebuilt when the limits change
+        changed = dict(config)
+        changed['oauth.google.com.max_concurrency'] = '2'
+        utilconfig.push_thread_config(changed)
+        try:
+            self.assertEqual(
+                services._get_bulkhead('google.com').max_concurrency, 2)
+        finally:
+            utilconfig.pop_thread_config(changed)
+        bulkhead = services._get_bulkhead('google.com')
+        self.assertEqual(bulkhead.max_concurrency, 1)
+
+        # all the slots are taken
+        bulkhead.acquire()
+        res, error = services.sendmessage('google.com', _ACCOUNT, '', args,
+                                          None)
+        self.assertEqual(res, None)
+        self.assertEqual(error['status'], 503)
+
+        bulkhead.release()
+        res, error = services.sendmessage('google.com', _ACCOUNT, '', args,
+                                          None)
+        self.assertEqual(res, {'status': 'message sent'})
+        self.assertEqual(bulkhead.active, 0)
+
+    def test_bulkhead_breaker(self):
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+        config = dict(_CONFIG)
+        config['oauth.google.com.max_concurrency'] = '1'
+        setup_config(config)
+
+        services = Services(['google.com'], circuit_breaker={})
+        services.initialize('google.com')
+        bulkhead = services._get_bulkhead('google.com')
+        bulkhead.max_queue = 1
+
+        # an open breaker rejects the call without queuing it
+        bulkhead.acquire()
+        services._breakers['google.com']._open(time.time())
+        res, error = services.sendmessage('google.com', _ACCOUNT, '', args,
+                                          None)
+        self.assertEqual(error['message'], 'the service is unavailable')
+        self.assertEqual(bulkhead.waiting, 0)
+        bulkhead.release()
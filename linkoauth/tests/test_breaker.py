@@ -0,0 +1,81 @@
+import time
+import unittest
+
+from linkoauth.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def _calls(self, breaker, success, count):
+        for i in range(count):
+            ticket = breaker.allow()
+            self.assertTrue(ticket)
+            breaker.record(ticket, success)
+
+    def test_opens(self):
+        breaker = CircuitBreaker(min_calls=10, failure_rate=0.5)
+        self._calls(breaker, True, 5)
+        self._calls(breaker, False, 4)
+        # not enough calls yet
+        self.assertEqual(breaker.state, CLOSED)
+        self._calls(breaker, False, 1)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_ignored_outcomes(self):
+        breaker = CircuitBreaker(min_calls=2, failure_rate=0.5)
+        self._calls(breaker, None, 10)
+        self._calls(breaker, False, 1)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_window(self):
+        breaker = CircuitBreaker(window=0.2, buckets=2, min_calls=2)
+        self._calls(breaker, False, 1)
+        time.sleep(0.3)
+        # the first failure is out of the window
+        self._calls(breaker, False, 1)
+        self.assertEqual(breaker.state, CLOSED)
+        self._calls(breaker, False, 1)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(min_calls=1, reset_timeout=0.1, probes=2)
+        self._calls(breaker, False, 1)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.2)
+
+        # two probes are let through
+        first = breaker.allow()
+        self.assertTrue(first)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        second = breaker.allow()
+        self.assertTrue(second)
+        self.assertFalse(breaker.allow())
+        breaker.record(first, True)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        breaker.record(second, True)
+        self.assertEqual(breaker.state, CLOSED)
+
+        # a failed probe opens the breaker again
+        self._calls(breaker, False, 1)
+        time.sleep(0.2)
+        self._calls(breaker, False, 1)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_late_outcomes(self):
+        breaker = CircuitBreaker(min_calls=1, reset_timeout=0.1, probes=1)
+        late = breaker.allow()
+        self._calls(breaker, False, 1)
+        self.assertEqual(breaker.state, OPEN)
+        time.sleep(0.2)
+        probe = breaker.allow()
+        self.assertTrue(probe)
+
+        # a call made while closed is not a probe
+        breaker.record(late, True)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())
+
+        breaker.record(probe, True)
+        self.assertEqual(breaker.state, CLOSED)
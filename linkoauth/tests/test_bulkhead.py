@@ -0,0 +1,45 @@
+import threading
+import time
+import unittest
+
+from linkoauth.bulkhead import Bulkhead
+
+
+class TestBulkhead(unittest.TestCase):
+
+    def test_reject(self):
+        bulkhead = Bulkhead(2)
+        self.assertTrue(bulkhead.acquire())
+        self.assertTrue(bulkhead.acquire())
+        # no queue
+        self.assertFalse(bulkhead.acquire())
+        bulkhead.release()
+        self.assertTrue(bulkhead.acquire())
+
+    def test_queue(self):
+        bulkhead = Bulkhead(1, max_queue=1, timeout=5)
+        self.assertTrue(bulkhead.acquire())
+        acquired = []
+
+        def _wait():
+            acquired.append(bulkhead.acquire())
+
+        waiter = threading.Thread(target=_wait)
+        waiter.start()
+        while bulkhead.waiting == 0:
+            time.sleep(0.01)
+
+        # the queue is full
+        self.assertFalse(bulkhead.acquire())
+        bulkhead.release()
+        waiter.join()
+        self.assertEqual(acquired, [True])
+        self.assertEqual(bulkhead.active, 1)
+
+    def test_timeout(self):
+        bulkhead = Bulkhead(1, max_queue=1, timeout=0.1)
+        self.assertTrue(bulkhead.acquire())
+        start = time.time()
+        self.assertFalse(bulkhead.acquire())
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEqual(bulkhead.waiting, 0)
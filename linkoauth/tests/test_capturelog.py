@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from linkoauth.capturelog import CaptureLog, iter_captures, export
+
+
+class TestCaptureLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'log')
+        os.mkdir(self.log)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _captures(self, count):
+        return [('http-example.com-%d' % i, {'reason': 'r%d' % i},
+                 [('request-0', 'GET /%d\r\n\r\n' % i),
+                  ('response-0', 'HTTP/1.1 200 OK\r\n\r\n' + 'x' * i)])
+                for i in range(count)]
+
+    def test_roundtrip(self):
+        captures = self._captures(20)
+        for compress in (True, False):
+            # small segments, so they rotate
+            writer = CaptureLog(self.log, segment_size=200,
+                                compress=compress)
+            for capture in captures:
+                writer.write(*capture)
+            writer.close()
+            self.assertEqual(list(iter_captures(self.log)), captures)
+            self.assertTrue(len(os.listdir(self.log)) > 1)
+            shutil.rmtree(self.log)
+            os.mkdir(self.log)
+
+    def test_truncated(self):
+        writer = CaptureLog(self.log)
+        for capture in self._captures(3):
+            writer.write(*capture)
+        writer.close()
+        segment = os.path.join(self.log, os.listdir(self.log)[0])
+        with open(segment, 'rb') as f:
+            data = f.read()
+        with open(segment, 'wb') as f:
+            f.write(data[:-5])
+        self.assertEqual(list(iter_captures(segment)), self._captures(2))
+
+    def test_export(self):
+        writer = CaptureLog(self.log)
+        for capture in self._captures(3):
+            writer.write(*capture)
+        writer.close()
+
+        dest = os.path.join(self.dir, 'captures')
+        os.mkdir(dest)
+        self.assertEqual(export(self.log, dest), 3)
+        capture = os.path.join(dest, 'http-example.com-2')
+        self.assertEqual(sorted(os.listdir(capture)),
+                         ['meta.json', 'request-0', 'response-0'])
+        with open(os.path.join(capture, 'meta.json')) as f:
+            self.assertEqual(json.load(f), {'reason': 'r2'})
+        with open(os.path.join(capture, 'response-0')) as f:
+            self.assertEqual(f.read(), 'HTTP/1.1 200 OK\r\n\r\nxx')
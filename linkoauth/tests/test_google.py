@@ -144,3 +144,33 @@ class TestBasics(unittest.TestCase):
 
         status = services.get_status('google.com')
         self.assertEquals(status, (True, 1, 1))
+
+    def test_circuit_breaker(self):
+        message = ''
+        args = {'to': 'tarek@ziade.org',
+                'subject': 'xxx',
+                'title': 'the title',
+                'description': 'some description',
+                'link': 'http://example.com',
+                'shorturl': 'http://example.com'}
+
+        breaker = {'min_calls': 2, 'failure_rate': 0.5, 'reset_timeout': 60}
+        services = Services(['google.com'], circuit_breaker=breaker)
+        services.initialize('google.com')
+
+        _SMTP.working = False
+        try:
+            for i in range(2):
+                services.sendmessage('google.com', _ACCOUNT, message, args,
+                                     None)
+        finally:
+            _SMTP.working = True
+
+        # the breaker is open, calls fail without reaching the provider
+        res, error = services.sendmessage('google.com', _ACCOUNT, message,
+                                          args, None)
+        self.assertEqual(res, None)
+        self.assertEqual(error['status'], 503)
+
+        status = services.get_status('google.com')
+        self.assertEquals(status, (True, 0, 2))
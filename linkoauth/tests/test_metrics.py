@@ -0,0 +1,36 @@
+import unittest
+
+from linkoauth.metrics import Histogram, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 2, 3))
+        for value in [0.5] * 90 + [1.5] * 5 + [2.5] * 4 + [10]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [90, 5, 4, 1])
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(95), 2)
+        self.assertEqual(histogram.percentile(99), 3)
+        self.assertEqual(histogram.percentile(100), 10)
+        self.assertEqual(Histogram().percentile(99), None)
+
+    def test_timed(self):
+        metrics = Metrics()
+        with metrics.timed('a', 'sendmessage'):
+            stats = metrics.snapshot()['a']['sendmessage']
+            self.assertEqual(stats['in_flight'], 1)
+            self.assertEqual(stats['count'], 0)
+
+        try:
+            with metrics.timed('a', 'sendmessage'):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        stats = metrics.snapshot()['a']['sendmessage']
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['p99'], 0.01)
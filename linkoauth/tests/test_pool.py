@@ -0,0 +1,56 @@
+import time
+import unittest
+
+from linkoauth.pool import RequesterPool, fingerprint
+
+
+class TestRequesterPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = RequesterPool(size=2, ttl=300)
+        first = pool.get(('a', '1'), object)
+        self.assertTrue(pool.get(('a', '1'), object) is first)
+        self.assertFalse(pool.get(('a', '2'), object) is first)
+
+    def test_lru(self):
+        pool = RequesterPool(size=2, ttl=300)
+        a = pool.get(('a', '1'), object)
+        pool.get(('b', '1'), object)
+        # touching 'a' makes 'b' the oldest entry
+        pool.get(('a', '1'), object)
+        pool.get(('c', '1'), object)
+        self.assertEqual(len(pool), 2)
+        self.assertTrue(pool.get(('a', '1'), object) is a)
+        self.assertEqual(sorted(pool._items.keys()),
+                         [('a', '1'), ('c', '1')])
+
+    def test_ttl(self):
+        pool = RequesterPool(size=2, ttl=0.1)
+        a = pool.get(('a', '1'), object)
+        time.sleep(0.2)
+        self.assertFalse(pool.get(('a', '1'), object) is a)
+
+    def test_invalidate(self):
+        pool = RequesterPool()
+        a = pool.get(('a', '1'), object)
+        pool.get(('a', '2'), object)
+        b = pool.get(('b', '1'), object)
+        pool.invalidate('a', '1')
+        self.assertFalse(pool.get(('a', '1'), object) is a)
+        pool.invalidate('a')
+        self.assertEqual(pool._items.keys(), [('b', '1')])
+        self.assertTrue(pool.get(('b', '1'), object) is b)
+
+    def test_fingerprint(self):
+        account = {'oauth_token': 'xxx', 'oauth_token_secret': 'xxx'}
+        self.assertEqual(fingerprint(account), fingerprint(dict(account)))
+        changed = dict(account, oauth_token='yyy')
+        self.assertNotEqual(fingerprint(account), fingerprint(changed))
+        self.assertEqual(fingerprint({'token': object()}), None)
+
+    def test_generation(self):
+        pool = RequesterPool()
+        gen1, gen2 = object(), object()
+        a = pool.get(('a', '1'), object, gen1)
+        self.assertTrue(pool.get(('a', '1'), object, gen1) is a)
+        self.assertFalse(pool.get(('a', '1'), object, gen2) is a)
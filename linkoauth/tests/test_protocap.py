@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from linkoauth import protocap
+from linkoauth.protocap import CaptureWriter, HttpRequestor
+from linkoauth.protocap import RecordingHttpBase
+from linkoauth.capturelog import iter_captures
+from linkoauth.util import setup_config
+
+
+class _Response(dict):
+    status = 200
+    reason = 'OK'
+
+
+class _Http(object):
+    def request(self, uri, method='GET', body='', headers=None):
+        return self._conn_request(None, uri, method, body, headers or {})
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        response = _Response({'status': '200', 'content-type': 'text/plain'})
+        return response, 'hello'
+
+
+class _RecordingHttp(RecordingHttpBase, _Http):
+    def __init__(self):
+        RecordingHttpBase.__init__(self)
+
+
+class _Requestor(HttpRequestor):
+    pc_http_class = _RecordingHttp
+
+
+class TestCaptureWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        setup_config({'protocol_capture_path': self.dir})
+
+    def tearDown(self):
+        protocap.get_capture_writer().flush()
+        shutil.rmtree(self.dir)
+
+    def test_save_capture(self):
+        requestor = _Requestor()
+        requestor.request('http://example.com/path')
+        requestor.save_capture('testing')
+        protocap.get_capture_writer().flush()
+
+        captures = os.listdir(self.dir)
+        self.assertEqual(len(captures), 1)
+        self.assertTrue(captures[0].startswith('http-example.com-'))
+        capture = os.path.join(self.dir, captures[0])
+        with open(os.path.join(capture, 'meta.json')) as f:
+            self.assertEqual(json.load(f),
+                             {'protocol': 'http', 'reason': 'testing',
+                              'uri': 'http://example.com/path'})
+        with open(os.path.join(capture, 'response-0')) as f:
+            self.assertTrue(f.read().endswith('\r\n\r\nhello'))
+
+    def test_capture_log(self):
+        setup_config({'protocol_capture_path': self.dir,
+                      'protocol_capture_format': 'log'})
+        requestor = _Requestor()
+        requestor.request('http://example.com/path')
+        requestor.save_capture('testing')
+        requestor.save_capture('testing again')
+        protocap.get_capture_writer().flush()
+
+        # a single segment file holds both captures
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        captures = list(iter_captures(self.dir))
+        self.assertEqual([meta['reason'] for name, meta, files in captures],
+                         ['testing', 'testing again'])
+        self.assertEqual([filename for filename, data in captures[0][2]],
+                         ['request-0', 'response-0'])
+
+    def test_sampling(self):
+        setup_config({'protocol_capture_path': self.dir,
+                      'protocol_capture_sample_rate': '0.5',
+                      'protocol_capture_sample_rate.http': '0'})
+        requestor = _Requestor()
+        requestor.request('http://example.com/path')
+        skipped = protocap.limiter.skipped
+        for i in range(10):
+            requestor.save_capture('testing')
+        protocap.get_capture_writer().flush()
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(protocap.limiter.skipped, skipped + 10)
+
+    def test_rate_limit(self):
+        setup_config({'protocol_capture_path': self.dir,
+                      'protocol_capture_rate': '0.001',
+                      'protocol_capture_burst': '2'})
+        requestor = _Requestor()
+        requestor.request('http://example.com/path')
+        for i in range(5):
+            requestor.save_capture('first reason')
+            requestor.save_capture('second reason')
+        protocap.get_capture_writer().flush()
+
+        # each reason gets its own bucket
+        self.assertEqual(len(os.listdir(self.dir)), 4)
+
+    def test_not_recording(self):
+        requestor = _Requestor()
+        setup_config({})
+        requestor.request('http://example.com/path')
+        self.assertEqual(requestor.http.capture['connections'], [])
+
+        setup_config({'protocol_capture_path': self.dir,
+                      'protocol_capture_sample_rate.http:example.com': '0'})
+        requestor.request('http://example.com/path')
+        self.assertEqual(requestor.http.capture['connections'], [])
+        requestor.request('http://example.org/path')
+        self.assertEqual(len(requestor.http.capture['connections']), 1)
+
+    def test_truncated(self):
+        setup_config({'protocol_capture_path': self.dir,
+                      'protocol_capture_max_body': '3'})
+        requestor = _Requestor()
+        requestor.request('http://example.com/path', 'POST', 'abcdef')
+        requestor.save_capture('testing')
+        protocap.get_capture_writer().flush()
+
+        capture = os.path.join(self.dir, os.listdir(self.dir)[0])
+        with open(os.path.join(capture, 'meta.json')) as f:
+            meta = json.load(f)
+        self.assertEqual(meta['truncated'], {'request-0': 6,
+                                             'response-0': 5})
+        with open(os.path.join(capture, 'request-0')) as f:
+            self.assertTrue(f.read().endswith('\r\n\r\nabc'))
+        with open(os.path.join(capture, 'response-0')) as f:
+            self.assertTrue(f.read().endswith('\r\n\r\nhel'))
+
+    def test_drop(self):
+        writer = CaptureWriter(size=2)
+        blocked = threading.Event()
+        release = threading.Event()
+        written = []
+
+        def _write(index):
+            blocked.set()
+            release.wait()
+            written.append(index)
+
+        # the first one keeps the thread busy, two wait in the queue
+        self.assertTrue(writer.submit(_write, 0))
+        blocked.wait()
+        self.assertTrue(writer.submit(_write, 1))
+        self.assertTrue(writer.submit(_write, 2))
+        self.assertFalse(writer.submit(_write, 3))
+        self.assertEqual(writer.dropped, 1)
+
+        release.set()
+        writer.flush()
+        self.assertEqual(written, [0, 1, 2])
@@ -0,0 +1,102 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+from linkoauth.capturelog import CaptureLog, write_capture_dir
+from linkoauth.protocap import HttpRequestor
+from linkoauth.replay import ReplayIndex, ReplayServer, normalize_query
+from linkoauth.replay import replaying
+from linkoauth.util import setup_config
+
+
+def _capture(uri, path, body, truncated=None):
+    meta = {'protocol': 'http', 'reason': 'testing', 'uri': uri}
+    if truncated:
+        meta['truncated'] = truncated
+    files = [('request-0', 'GET %s\r\naccept: */*\r\n\r\n' % path),
+             ('response-0', 'HTTP/1.1 200 OK\r\nstatus: 200\r\n'
+                            'content-type: application/json\r\n'
+                            'content-length: 1000\r\n\r\n' + body)]
+    return meta, files
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        setup_config({})
+        write_capture_dir(self.dir, 'http-example.com-1', *_capture(
+            'http://example.com/feed?b=2&a=1',
+            '/feed?b=2&a=1&oauth_nonce=1', '{"first": 1}'))
+        write_capture_dir(self.dir, 'http-example.com-2', *_capture(
+            'http://example.com/feed?a=1&b=2',
+            '/feed?a=1&b=2', '{"second": 2}'))
+        write_capture_dir(self.dir, 'http-example.com-3', *_capture(
+            'http://example.com/big', '/big', '{"trunc',
+            {'response-0': 1000}))
+        write_capture_dir(self.dir, 'smtp-example.com-4',
+                          {'protocol': 'smtp'}, [('smtp-trace', '> EHLO')])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query('b=2&oauth_nonce=3&a=1&c='),
+                         'a=1&b=2&c=')
+
+    def test_index(self):
+        index = ReplayIndex(self.dir)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.skipped, 1)
+        # the responses are served in turn
+        bodies = [index.lookup('GET', 'Example.com:80', '/feed',
+                               'oauth_nonce=5&a=1&b=2')[3]
+                  for i in range(3)]
+        self.assertEqual(bodies, ['{"first": 1}', '{"second": 2}',
+                                  '{"first": 1}'])
+        self.assertEqual(index.lookup('GET', 'example.com', '/big', ''),
+                         None)
+        self.assertEqual(index.misses, 1)
+
+    def test_capture_log(self):
+        path = os.path.join(self.dir, 'log')
+        os.mkdir(path)
+        writer = CaptureLog(path)
+        meta, files = _capture('http://example.org/x', '/x', 'logged')
+        writer.write('http-example.org-1', meta, files)
+        writer.close()
+
+        index = ReplayIndex(path)
+        self.assertEqual(index.lookup('GET', 'example.org', '/x', '')[3],
+                         'logged')
+
+    def test_replaying(self):
+        index = ReplayIndex(self.dir)
+        with replaying(index):
+            response, content = HttpRequestor().request(
+                    'http://example.com/feed?a=1&b=2')
+            self.assertEqual(response.status, 200)
+            self.assertEqual(json.loads(content), {'first': 1})
+            response, content = HttpRequestor().request(
+                    'http://example.com/unknown')
+            self.assertEqual(response.status, 404)
+        self.assertFalse(hasattr(HttpRequestor.pc_http_class,
+                                 'replay_index'))
+
+    def test_server(self):
+        server = ReplayServer(ReplayIndex(self.dir), host='example.com')
+        server.start()
+        try:
+            url = 'http://%s:%d/feed?b=2&a=1' % server.server_address
+            response = urllib2.urlopen(url)
+            self.assertEqual(response.info()['content-type'],
+                             'application/json')
+            self.assertEqual(response.read(), '{"first": 1}')
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                              url.replace('feed', 'unknown'))
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from linkoauth import sstatus
+from linkoauth.shmstatus import SharedMemoryBackend
+
+
+class TestSharedMemoryBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'status')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared(self):
+        server = 'shm:' + self.path
+        first = sstatus.ServicesStatus(['a', 'b'], server)
+        second = sstatus.ServicesStatus(['a'], server)
+        self.assertEqual(first.get_status('a'), (True, 0, 0))
+
+        first.update_status('a', True)
+        second.update_status('a', False, 3)
+        self.assertEqual(first.get_status('a'), (True, 1, 3))
+        self.assertEqual(second.get_status('a'), (True, 1, 3))
+        self.assertEqual(second.get_status('b'), (True, 0, 0))
+        self.assertEqual(second.get_status('c'), (None, 0, 0))
+
+        second.disable('a')
+        self.assertEqual(first.get_status('a'), (False, 1, 3))
+        first.initialize('a')
+        self.assertEqual(second.get_status('a'), (True, 0, 0))
+
+    def test_window(self):
+        services = sstatus.ServicesStatus(['a'], 'shm:' + self.path,
+                                          ttl=0.4, bucket_width=0.1)
+        services.update_status('a', False)
+        time.sleep(0.2)
+        services.update_status('a', True)
+        self.assertEqual(services.get_status('a'), (True, 1, 1))
+        time.sleep(0.25)
+        self.assertEqual(services.get_status('a'), (True, 1, 0))
+
+    def test_buffered(self):
+        services = sstatus.ServicesStatus(['a'], 'shm:' + self.path,
+                                          flush_interval=60)
+        services.update_status('a', True, 2)
+        services.update_status('a', False)
+        self.assertEqual(services.get_status('a'), (True, 0, 0))
+        services.flush()
+        self.assertEqual(services.get_status('a'), (True, 2, 1))
+
+    def test_layout(self):
+        window = sstatus.CounterWindow(600, 60)
+        backend = SharedMemoryBackend(self.path, ['a'], window, slots=2)
+        try:
+            backend.incr('b', True)
+            self.assertRaises(sstatus.StatusWriteError, backend.incr, 'c',
+                              True)
+        finally:
+            backend.close()
+
+        # the processes must agree on the window
+        self.assertRaises(ValueError, SharedMemoryBackend, self.path, ['a'],
+                          sstatus.CounterWindow(600, 30))
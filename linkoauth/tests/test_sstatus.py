@@ -20,10 +20,15 @@
 #
 # Contributor(s): Tarek Ziade <tarek@ziade.org>
 #
+import json
 import mock
+import random
+import threading
 import time
 import unittest
+from StringIO import StringIO
 from linkoauth import sstatus
+from linkoauth.metrics import Metrics
 #import ServicesStatus, ServicesStatusMiddleware
 from linkoauth.tests.test_base import MockCache
 
@@ -61,6 +66,79 @@ class TestServiceStatus(unittest.TestCase):
         self.assertEqual(self.services.get_status('a'),
                          (True, 10, 20))
 
+    def test_single_read(self):
+        self._ping_status()
+        get_multi = mock.Mock(wraps=self.mock_cache.get_multi)
+        with mock.patch.object(self.mock_cache, 'get_multi', get_multi):
+            self.assertEqual(self.services.get_status('a'),
+                             (True, 10, 20))
+        self.assertEqual(get_multi.call_count, 1)
+
+    def test_setup_once(self):
+        services = sstatus.ServicesStatus(['a', 'e'])
+        get_multi = mock.Mock(wraps=self.mock_cache.get_multi)
+        with mock.patch.object(self.mock_cache, 'get_multi', get_multi):
+            self.assertEqual(services.get_status('e'), (True, 0, 0))
+            services.update_status('e', True)
+            self.assertEqual(services.get_status('e'), (True, 1, 0))
+
+        # a single lookup sets up the services, then one read per status
+        self.assertEqual(get_multi.call_count, 3)
+
+    def test_cache_cleared(self):
+        self.assertEqual(self.services.get_status('a'), (True, 0, 0))
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5])
+        request = FakeEnviron(HTTP_X_TARGET_DOMAIN='a')
+
+        def start_response(status, headers):
+            pass
+
+        # a memcached restart loses the keys set up
+        self.mock_cache._cache.clear()
+        self.assertEqual(self.services.get_status('a'), (True, 0, 0))
+        self.assertEqual(app(request, start_response)[0], 'Hello World')
+        self.services.update_status('a', True)
+        self.assertEqual(self.services.get_status('a'), (True, 1, 0))
+
+    def test_shards(self):
+        writer = sstatus.ServicesStatus(['s'], shards=4)
+        reader = sstatus.ServicesStatus(['s'], shards=4)
+
+        def _update():
+            for i in range(5):
+                writer.update_status('s', True)
+            writer.update_status('s', False)
+
+        threads = [threading.Thread(target=_update) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(reader.get_status('s'), (True, 40, 8))
+
+        # all the shards are read at once
+        get_multi = mock.Mock(wraps=self.mock_cache.get_multi)
+        with mock.patch.object(self.mock_cache, 'get_multi', get_multi):
+            reader.get_status('s')
+        self.assertEqual(get_multi.call_count, 1)
+
+        # the increments were spread over several keys
+        window = reader._backend.window
+        keys = window.keys('s', 'succ')[:window.shards]
+        used = [key for key in keys if self.mock_cache.get(key)]
+        self.assertTrue(len(used) > 1)
+
+    def test_client_pool(self):
+        cache = self.services._backend._cache
+        pool = cache._get_pool()
+        self.assertEqual(pool.qsize(), 10)
+        self.assertTrue(cache._get_pool() is pool)
+
+        # a forked process gets its own clients
+        with mock.patch('os.getpid', lambda: -1):
+            self.assertFalse(cache._get_pool() is pool)
+
     def _ping_status(self, service='a', succ=10, fail=20):
         for i in range(succ):
             self.services.update_status(service, True)
@@ -74,6 +152,12 @@ class TestServiceStatus(unittest.TestCase):
         thresholds = [0.5, 0.9, 0.1]
         app = sstatus.ServicesStatusMiddleware(origin_app, services,
                                                thresholds)
+        # the requests below the treshold are always shed
+        dice = mock.Mock(wraps=random)
+        dice.random = lambda: 0.
+        random_patcher = mock.patch.object(sstatus, 'random', dice)
+        random_patcher.start()
+        self.addCleanup(random_patcher.stop)
 
         # 10 successes, 20 failures
         self._ping_status()
@@ -119,18 +203,324 @@ class TestServiceStatus(unittest.TestCase):
         self.assertEqual(res[0], 'Hello World')
 
     def test_ttl(self):
-        services = sstatus.ServicesStatus(['d'], ttl=1)
+        services = sstatus.ServicesStatus(['d'], ttl=1, bucket_width=0.1)
         try:
             for i in range(10):
                 services.update_status('d', True)
 
-            status = self.services.get_status('d')
+            status = services.get_status('d')
             self.assertEqual(status, (True, 10, 0))
 
             time.sleep(2.)
             self.mock_cache.pdb = True
-            status = self.services.get_status('d')
+            status = services.get_status('d')
             self.assertEqual(status, (True, 0, 0))
 
         finally:
             services.initialize('d')
+
+    def test_buffered(self):
+        services = sstatus.ServicesStatus(['a'], flush_interval=60,
+                                          flush_size=1000)
+        services.initialize('a')
+        self._ping_status(succ=3, fail=2)
+        services.update_status('a', True, 5)
+        services.update_status('a', False)
+
+        # nothing is written until the buffer is flushed
+        self.assertEqual(services.get_status('a'), (True, 3, 2))
+        services.flush()
+        self.assertEqual(services.get_status('a'), (True, 8, 3))
+
+    def test_buffered_partial(self):
+        services = sstatus.ServicesStatus(['a'], flush_interval=60,
+                                          flush_size=1000)
+        services.initialize('a')
+        services.update_status('a', True, 2)
+        services.update_status('a', False, 3)
+
+        # the second increment call fails, only its delta is kept
+        incr_multi = self.mock_cache.incr_multi
+        calls = []
+
+        def _incr_multi(keys, delta=1):
+            calls.append(delta)
+            if len(calls) == 2:
+                raise sstatus.WriteError()
+            return incr_multi(keys, delta)
+
+        with mock.patch.object(self.mock_cache, 'incr_multi', _incr_multi):
+            services.flush()
+        first = calls[0] == 2 and (True, 2, 0) or (True, 0, 3)
+        self.assertEqual(services.get_status('a'), first)
+        services.flush()
+        self.assertEqual(services.get_status('a'), (True, 2, 3))
+
+    def test_buffered_size(self):
+        services = sstatus.ServicesStatus(['a'], flush_interval=60,
+                                          flush_size=10)
+        for i in range(10):
+            services.update_status('a', True)
+
+        # reaching the size wakes up the flushing thread
+        for i in range(50):
+            if services.get_status('a') == (True, 10, 0):
+                break
+            time.sleep(0.1)
+        self.assertEqual(services.get_status('a'), (True, 10, 0))
+
+    def test_sliding_window(self):
+        services = sstatus.ServicesStatus(['d'], ttl=0.4, bucket_width=0.1)
+        services.update_status('d', False)
+        time.sleep(0.2)
+        services.update_status('d', True)
+        self.assertEqual(services.get_status('d'), (True, 1, 1))
+
+        # the failure leaves the window before the success
+        time.sleep(0.25)
+        self.assertEqual(services.get_status('d'), (True, 1, 0))
+        time.sleep(0.2)
+        self.assertEqual(services.get_status('d'), (True, 0, 0))
+
+    def test_shedding(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               probe_rate=0.1)
+        request = FakeEnviron(HTTP_X_TARGET_DOMAIN='a')
+
+        def rejected(count=1000):
+            res = [app(request, lambda *args: None)[0] for i in range(count)]
+            return res.count('The service is unavailable') / float(count)
+
+        # ratio of 0.25, half way to the treshold
+        self._ping_status(succ=10, fail=40)
+        self.assertTrue(0.4 < rejected() < 0.6)
+
+        # no successes at all, only the probes go through
+        self.services.initialize('a')
+        self._ping_status(succ=0, fail=10)
+        self.assertTrue(0.85 < rejected() < 0.95)
+
+        # the probes succeed, the ratio gets back over the treshold
+        self._ping_status(succ=5, fail=0)
+        self.assertEqual(rejected(), 0)
+
+    def test_retry_after(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               retry_after=150,
+                                               probe_rate=0)
+        request = FakeEnviron(HTTP_X_TARGET_DOMAIN='a')
+        headers = {}
+
+        def start_response(status, response_headers):
+            headers.update(response_headers)
+
+        def retry_after(delay):
+            with self._clock(start + delay):
+                app(request, start_response)
+            return int(headers['Retry-After'])
+
+        # 10s into the next bucket, the counters are still in the window
+        start = (int(time.time() / 60) + 1) * 60 + 10
+        self._ping_status(succ=0, fail=20)
+        dice = self._dice()
+
+        # the oldest bucket expires in 50s, then the delay doubles
+        self.assertEqual(retry_after(0), 50)
+        self.assertEqual(retry_after(60), 100)
+        self.assertEqual(retry_after(120), 150)
+
+        # a successful probe resets the backoff
+        with self._clock(start + 130):
+            self._ping_status(succ=1, fail=0)
+        self.assertEqual(retry_after(130), 40)
+
+        # the jitter takes up to half of the delay
+        dice.uniform = lambda low, high: low
+        self.assertEqual(retry_after(130), 20)
+        dice.uniform = lambda low, high: high
+
+        # a disabled service gets the static delay
+        self.services.disable('a')
+        self.assertEqual(retry_after(130), 150)
+
+    def _clock(self, now):
+        # only the references of sstatus are patched: other threads
+        # use the time and random modules too
+        clock = mock.Mock(wraps=time)
+        clock.time = lambda: now
+        return mock.patch.object(sstatus, 'time', clock)
+
+    def _dice(self):
+        dice = mock.Mock()
+        dice.random = lambda: 0.
+        dice.uniform = lambda low, high: high
+        patcher = mock.patch.object(sstatus, 'random', dice)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return dice
+
+    def test_retry_after_expiry(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               retry_after=150,
+                                               probe_rate=0)
+        request = FakeEnviron(HTTP_X_TARGET_DOMAIN='a')
+        headers = {}
+
+        def start_response(status, response_headers):
+            headers.update(response_headers)
+
+        def retry_after(delay, succ=0, fail=0):
+            with self._clock(start + delay):
+                self._ping_status(succ=succ, fail=fail)
+                app(request, start_response)
+            return int(headers['Retry-After'])
+
+        start = (int(time.time() / 60) + 1) * 60 + 10
+        self._dice()
+        self.assertEqual(retry_after(0, succ=5, fail=40), 50)
+        self.assertEqual(retry_after(540, fail=40), 150)
+
+        # the bucket holding the 5 successes leaves the window as a
+        # probe succeeds: the window total drops, the probe still counts
+        self.assertEqual(retry_after(610, succ=1), 40)
+        with self._clock(start + 610):
+            self.assertEqual(app._get_status('a')[:3], (True, 1, 40))
+
+    def _main(self, *args):
+        with mock.patch('sys.stdout', StringIO()) as stdout:
+            self.assertRaises(SystemExit, sstatus.main, list(args))
+        return stdout.getvalue()
+
+    def test_cli(self):
+        self._ping_status(succ=3, fail=1)
+        out = self._main('127.0.0.1:11211', 'a', 'status')
+        self.assertEqual(out, 'This service is enabled.\n'
+                              '3 successes, 1 failures.\n')
+
+        with mock.patch('linkoauth.sstatus._registered_domains',
+                        lambda: ['a', 'b']):
+            out = self._main('--all', '--json', '127.0.0.1:11211', 'status')
+            self.assertEqual(json.loads(out)['a'],
+                             {'enabled': True, 'successes': 3,
+                              'failures': 1})
+            self.assertEqual(json.loads(out)['b']['successes'], 0)
+
+            out = self._main('--all', '127.0.0.1:11211', 'status')
+            self.assertEqual(len(out.splitlines()), 3)
+
+            # watch mode, stopped after two reads
+            sleeps = []
+
+            def _sleep(interval):
+                sleeps.append(interval)
+                if len(sleeps) == 2:
+                    raise KeyboardInterrupt()
+                self._ping_status(succ=2, fail=0)
+
+            # the pool threads of other tests sleep too, so only the
+            # reference of sstatus is patched
+            clock = mock.Mock(wraps=time)
+            clock.sleep = _sleep
+            with mock.patch.object(sstatus, 'time', clock):
+                out = self._main('--all', '--watch', '--json',
+                                 '--interval', '1', '127.0.0.1:11211',
+                                 'status')
+        first, second = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual(sleeps, [1., 1.])
+        self.assertEqual(second['services']['a']['successes'], 5)
+        self.assertTrue(second['services']['a']['successes_per_second'] > 0)
+        self.assertEqual(second['services']['a']['failures_per_second'], 0)
+        self.assertFalse('successes_per_second' in first['services']['a'])
+
+    def test_watch_expiry(self):
+        # the window holds two buckets, the first one expires between
+        # the two reads of the watch
+        start = (int(time.time() / 60) + 1) * 60 + 10.
+        now = [start]
+        with self._clock(now[0]):
+            self._ping_status(succ=5, fail=3)
+
+        def _sleep(interval):
+            if now[0] > start:
+                raise KeyboardInterrupt()
+            now[0] += 120
+            with self._clock(now[0]):
+                self._ping_status(succ=2, fail=0)
+
+        clock = mock.Mock(wraps=time)
+        clock.time = lambda: now[0]
+        clock.sleep = _sleep
+        with mock.patch.object(sstatus, 'time', clock):
+            out = self._main('--watch', '--json', '--ttl', '120',
+                             '127.0.0.1:11211', 'a', 'status')
+        first, second = [json.loads(line)['services']['a']
+                         for line in out.splitlines()]
+        self.assertEqual((first['successes'], first['failures']), (5, 3))
+        self.assertEqual((second['successes'], second['failures']), (2, 0))
+        self.assertEqual(second['successes_per_second'], 2 / 120.)
+        self.assertEqual(second['failures_per_second'], 0)
+
+    def test_metrics_endpoint(self):
+        metrics = Metrics()
+        with metrics.timed('a', 'sendmessage'):
+            pass
+
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               metrics=metrics)
+        responses = []
+
+        def start_response(status, headers):
+            responses.append((status, headers))
+
+        request = FakeEnviron(PATH_INFO='/__metrics__')
+        res = json.loads(app(request, start_response)[0])
+        self.assertEqual(res['a']['sendmessage']['count'], 1)
+
+        request = FakeEnviron(PATH_INFO='/')
+        self.assertEqual(app(request, start_response)[0], 'Hello World')
+
+    def test_middleware_window(self):
+        # the middleware reads the counters written with another window
+        services = sstatus.ServicesStatus(['a'], ttl=300, bucket_width=30)
+        services.update_status('a', False, 20)
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               probe_rate=0, cache_ttl=300,
+                                               cache_bucket_width=30)
+        self.assertEqual(app._status_checker.window.keys('a', 'succ', 0),
+                         services.window.keys('a', 'succ', 0))
+        self.assertEqual(app._get_status('a')[:3], (True, 0, 20))
+
+    def test_middleware_refresh(self):
+        app = sstatus.ServicesStatusMiddleware(FakeWSGIApp(), ['a'], [0.5],
+                                               refresh_interval=60,
+                                               probe_rate=0)
+        request = FakeEnviron(HTTP_X_TARGET_DOMAIN='a')
+
+        def start_response(status, headers):
+            pass
+
+        # the first request reads the status
+        self.assertEqual(app(request, start_response)[0], 'Hello World')
+
+        # the status is then served from memory until the next refresh
+        self._ping_status(succ=0, fail=20)
+        self.assertEqual(app(request, start_response)[0], 'Hello World')
+        self.assertTrue(app._poller.refresh())
+        self.assertEqual(app(request, start_response)[0],
+                         'The service is unavailable')
+
+        # a failed refresh keeps the last known status
+        checker = app._status_checker
+        with mock.patch.object(checker, 'get_buckets',
+                               side_effect=sstatus.StatusReadError):
+            self.services.initialize('a')
+            self.assertFalse(app._poller.refresh())
+        self.assertEqual(app(request, start_response)[0],
+                         'The service is unavailable')
+
+        # and so does any other error
+        with mock.patch.object(checker, 'get_buckets',
+                               side_effect=sstatus.StatusWriteError):
+            self.assertFalse(app._poller.refresh())
+        self.assertEqual(app(request, start_response)[0],
+                         'The service is unavailable')
@@ -1,5 +1,7 @@
 import unittest
-from linkoauth.util import build_url
+
+import mock
+from linkoauth.util import build_url, setup_config, get_settings, config
 
 
 class TestUtil(unittest.TestCase):
@@ -15,3 +17,71 @@ class TestUtil(unittest.TestCase):
         expect = \
                 'https://graph.facebook.com/me?access_token=xxxx&fields=id%2Cf'
         self.assertTrue(res.startswith(expect))
+
+    def test_settings(self):
+        setup_config({'oauth.twitter.com.consumer_key': 'xxx',
+                      'oauth.twitter.com.consumer_secret': 'yyy',
+                      'oauth.facebook.com.app_id': 'zzz',
+                      'protocol_capture_success': 'true'})
+        settings = get_settings()
+        self.assertEqual(settings.get_provider('twitter.com'),
+                         {'consumer_key': 'xxx', 'consumer_secret': 'yyy'})
+        self.assertEqual(settings.get_provider('facebook.com'),
+                         {'app_id': 'zzz'})
+        self.assertEqual(settings.get_provider('yahoo.com'), {})
+        self.assertTrue(settings.capture_success)
+        self.assertFalse(settings.debug)
+
+        # the snapshot is read-only
+        twitter = settings.get_provider('twitter.com')
+        self.assertRaises(TypeError, twitter.__setitem__, 'version', '2')
+        self.assertRaises(TypeError, twitter.update, {})
+
+        # capture policies
+        self.assertEqual(settings.get_capture_policy('http', 'example.com'),
+                         (1., None, 10.))
+
+        # pushing a new configuration swaps the snapshot
+        setup_config({'oauth.twitter.com.consumer_key': 'aaa'})
+        self.assertFalse(get_settings() is settings)
+        self.assertEqual(get_settings().get_provider('twitter.com'),
+                         {'consumer_key': 'aaa'})
+
+    def test_settings_cache(self):
+        first = {'oauth.twitter.com.consumer_key': 'xxx'}
+        second = {'oauth.twitter.com.consumer_key': 'yyy'}
+        setup_config(first)
+        settings = get_settings()
+        with mock.patch('linkoauth.util.Settings') as compile:
+            # per-thread configurations don't recompile each other
+            config.push_thread_config(second)
+            try:
+                other = get_settings()
+                self.assertTrue(get_settings() is other)
+            finally:
+                config.pop_thread_config(second)
+            self.assertTrue(get_settings() is settings)
+            self.assertEqual(compile.call_count, 1)
+
+            # an equal copy of a configuration reuses its settings
+            copy = dict(first)
+            config.push_thread_config(copy)
+            try:
+                self.assertTrue(get_settings() is settings)
+            finally:
+                config.pop_thread_config(copy)
+            self.assertEqual(compile.call_count, 1)
+
+    def test_capture_policy(self):
+        setup_config({'protocol_capture_sample_rate': '0.5',
+                      'protocol_capture_sample_rate.http': '0.1',
+                      'protocol_capture_rate.http:graph.facebook.com': '2',
+                      'protocol_capture_burst': '5'})
+        settings = get_settings()
+        self.assertEqual(settings.get_capture_policy('smtp', 'gmail.com'),
+                         (0.5, None, 5.))
+        self.assertEqual(settings.get_capture_policy('http', 'yahoo.com'),
+                         (0.1, None, 5.))
+        self.assertEqual(settings.get_capture_policy('http',
+                                                     'graph.facebook.com'),
+                         (0.1, 2., 5.))
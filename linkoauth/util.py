@@ -24,6 +24,8 @@ import os
 import sgmllib
 import string
 import sys
+import threading
+from collections import OrderedDict
 from urllib import urlencode
 
 from webob.exc import status_map
@@ -113,8 +115,134 @@ def build_url(url, **params):
 config = DispatchingConfig()
 
 
+class FrozenDict(dict):
+    """A read-only dict."""
+    def _readonly(self, *args, **kw):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+_EMPTY = FrozenDict()
+
+# capture options, and their default values
+_CAPTURE_POLICY = (('protocol_capture_sample_rate', 1.),
+                   ('protocol_capture_rate', None),
+                   ('protocol_capture_burst', 10.))
+
+
+class Settings(object):
+    """Compiled, immutable view of a configuration mapping.
+
+    The provider options are indexed by provider name, so looking up the
+    options of a provider doesn't require a scan of the whole configuration.
+    """
+    def __init__(self, source):
+        self.source = source
+        providers = {}
+        for key, value in source.items():
+            if not key.startswith('oauth.'):
+                continue
+            # provider names contain dots, so the key is indexed under
+            # every possible split, like a prefix match would see it.
+            pos = key.find('.', len('oauth.'))
+            while pos != -1:
+                options = providers.setdefault(key[len('oauth.'):pos], {})
+                options[key[pos + 1:]] = value
+                pos = key.find('.', pos + 1)
+
+        self._providers = dict((provider, FrozenDict(options))
+                               for provider, options in providers.items())
+        self.capture_path = source.get('protocol_capture_path')
+        self.capture_success = asbool(source.get('protocol_capture_success'))
+        self.capture_queue_size = int(source.get(
+                'protocol_capture_queue_size', 100))
+        self.capture_format = source.get('protocol_capture_format', 'dir')
+        self.capture_max_body = int(source.get('protocol_capture_max_body',
+                                               64 * 1024))
+        self.capture_segment_size = int(source.get(
+                'protocol_capture_segment_size', 64 * 1024 * 1024))
+        self.capture_compress = asbool(source.get('protocol_capture_compress',
+                                                  True))
+        self._capture_policies = {}
+        for option, default in _CAPTURE_POLICY:
+            for key, value in source.items():
+                if key == option:
+                    scope = ''
+                elif key.startswith(option + '.'):
+                    scope = key[len(option) + 1:]
+                else:
+                    continue
+                policy = self._capture_policies.setdefault(scope, {})
+                policy[option] = float(value)
+        self.debug = asbool(source.get('debug', False))
+
+    def get_provider(self, provider):
+        """Returns the options of the "oauth.<provider>." namespace."""
+        return self._providers.get(provider, _EMPTY)
+
+    def get_capture_policy(self, protocol, host):
+        """Returns the (sample rate, rate, burst) of the captures.
+
+        Each option is looked up as "<option>.<protocol>:<host>", then
+        "<option>.<protocol>", then "<option>".  The rate is the number of
+        captures per second, None if unlimited.
+        """
+        res = []
+        for option, value in _CAPTURE_POLICY:
+            for scope in ('%s:%s' % (protocol, host), protocol, ''):
+                policy = self._capture_policies.get(scope)
+                if policy is not None and option in policy:
+                    value = policy[option]
+                    break
+            res.append(value)
+        return tuple(res)
+
+
+# compiled settings, by id of their configuration: (configuration, settings)
+_settings = OrderedDict()
+_settings_lock = threading.Lock()
+_SETTINGS_CACHE_SIZE = 32
+
+
+def _cache_settings(source, settings):
+    # the caller holds the lock.  The configuration is kept referenced, so
+    # its id is not reused while it's cached.
+    _settings.pop(id(source), None)
+    _settings[id(source)] = source, settings
+    while len(_settings) > _SETTINGS_CACHE_SIZE:
+        _settings.popitem(last=False)
+
+
+def get_settings():
+    """Returns the compiled settings of the current configuration.
+
+    The settings are cached per configuration object, so thread-local and
+    per-request configurations don't recompile each other's.  A
+    configuration equal to a cached one (like a per-request copy) gets the
+    same Settings object.
+    """
+    current = config.current_conf()
+    entry = _settings.get(id(current))
+    if entry is not None and entry[0] is current:
+        return entry[1]
+
+    with _settings_lock:
+        for source, settings in reversed(_settings.values()):
+            if source == current:
+                break
+        else:
+            settings = Settings(current)
+        _cache_settings(current, settings)
+    return settings
+
+
 def setup_config(appconfig):
+    settings = Settings(appconfig)
     config.push_process_config(appconfig)
+    with _settings_lock:
+        _cache_settings(appconfig, settings)
 
 
 def _cached_template(template_name, render_func, ns_options=(),
@@ -0,0 +1,163 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+"""
+Threads used to run provider calls concurrently, and background threads.
+"""
+import os
+import threading
+from itertools import islice
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+
+from linkoauth.util import config
+
+
+def _with_config(func):
+    """Wraps func so it runs with the configuration of the calling thread.
+
+    The pool threads only see the process configuration, while the caller
+    may have a thread-local one.
+    """
+    try:
+        conf = config.current_conf()
+    except AttributeError:
+        return func
+
+    def _run(*args, **kw):
+        config.push_thread_config(conf)
+        try:
+            return func(*args, **kw)
+        finally:
+            config.pop_thread_config(conf)
+    return _run
+
+
+class BackgroundThread(object):
+    """Runs *target* in a daemon thread.
+
+    The thread is started by the first call to start(), and again in a
+    child process after a fork.  *setup* is called before each start.
+    """
+    def __init__(self, target, setup=None):
+        self._target = target
+        self._setup = setup
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self):
+        """True if the thread was started in this process."""
+        return self._thread is not None and self._pid == os.getpid()
+
+    def start(self):
+        if self.started:
+            return
+        with self._lock:
+            if not self.started:
+                if self._setup is not None:
+                    self._setup()
+                thread = threading.Thread(target=self._target)
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+                self._pid = os.getpid()
+
+
+class WorkerPool(object):
+    """Lazily created pool of *size* threads.
+
+    The threads are created on first use, and created again in a child
+    process after a fork.
+    """
+    def __init__(self, size=10):
+        self.size = size
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        pid = os.getpid()
+        if self._pool is None or self._pid != pid:
+            with self._lock:
+                if self._pool is None or self._pid != pid:
+                    self._pool = ThreadPool(self.size)
+                    self._pid = pid
+        return self._pool
+
+    def submit(self, func, *args, **kw):
+        """Schedules func(*args, **kw) and returns an AsyncResult."""
+        return self._get_pool().apply_async(_with_config(func), args, kw)
+
+    def map(self, func, items, max_workers=None):
+        """Calls func(item) for each item and returns the results in order.
+
+        No more than *max_workers* calls run at the same time, and never
+        more than the size of the pool.  If a call
+        raises, the first exception is raised once all calls are done.
+
+        This blocks until the calls are done, so it must not be called from
+        one of the pool threads.
+        """
+        items = list(items)
+        if max_workers is None or max_workers > self.size:
+            max_workers = self.size
+        max_workers = max(max_workers, 1)
+        results = [None] * len(items)
+        errors = []
+        done = Queue()
+
+        func = _with_config(func)
+
+        def _run(index):
+            try:
+                results[index] = func(items[index])
+            except Exception, e:
+                errors.append((index, e))
+            finally:
+                done.put(index)
+
+        pool = self._get_pool()
+        pending = iter(range(len(items)))
+        running = 0
+        for index in islice(pending, max_workers):
+            pool.apply_async(_run, (index,))
+            running += 1
+
+        while running:
+            done.get()
+            running -= 1
+            for index in islice(pending, 1):
+                pool.apply_async(_run, (index,))
+                running += 1
+
+        if errors:
+            raise min(errors)[1]
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.close()
+                self._pool.join()
+            self._pool = None